@@ -5,20 +5,46 @@
 '''A naive implementation of the actor model.'''
 
 __all__ = [
+    'POOLS',
+    'CancellationToken',
+    'Cancelled',
+    'Priority',
+    'PriorityMessageQueue',
     'actor',
+    'call_in_parent',
+    'cancellation',
+    'check_cancelled',
     'interface',
+    'is_cancelled',
+    'is_child_process',
     'join',
 ]
 
+import asyncio
 import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import contextvars
+import enum
 import functools
+import heapq
+import importlib
+import inspect
 import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
 import queue
 import threading
 import time
+import weakref
 
 import cc
 import cc.inits
+import cc.metrics
+import cc.retry
 
 from cc import logging
 
@@ -28,32 +54,235 @@ def init_argparser():
     parser = cc.statics.parser
     # It seems like that Comedy Central limits the concurrent
     # connections to be 6.  Since rtmp.download() implements
-    # exponential back-off, it should be okay to set --jobs
-    # greater than 6.
+    # exponential back-off, and cc.http caps the in-flight requests
+    # per host (see --http-host-limit), it should be okay to set
+    # --jobs greater than 6.
     parser.add_argument(
         '-j', '--jobs', type=int, default=1,
         help='set number of worker threads (default: %(default)s)')
+    for pool, what in (('meta', 'metadata'),
+                       ('small', 'small files'),
+                       ('media', 'media')):
+        parser.add_argument(
+            '--jobs-%s' % pool, type=int,
+            help='set number of worker threads of a separate pool for '
+                 'downloading %s (default: share the --jobs pool)' % what)
     parser.add_argument(
-        '--queue', choices=('fifo', 'lifo'), default='fifo',
+        '--processes', type=int, default=0,
+        help='run cpu-heavy actors in this many child processes '
+             '(default: run them on threads)')
+    parser.add_argument(
+        '--runtime', choices=('threads', 'asyncio'), default='threads',
+        help='run messages on worker threads or as asyncio tasks '
+             '(see cc.actor.aio) (default: %(default)s)')
+    parser.add_argument(
+        '--queue', choices=('priority', 'fifo', 'lifo'), default='priority',
         help='set message queue type (default: %(default)s)')
+    parser.add_argument(
+        '--queue-aging', type=float, default=60,
+        help='for the priority queue, promote a message by one priority '
+             'class for every this many seconds it waits '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--mailbox-limit', action='append', metavar='CLASS=N',
+        help='set max number of queued messages of a priority class '
+             '(metadata, small, or bulk; N <= 0 means no limit), beyond '
+             'which senders are blocked (default: %s)' %
+             ' '.join('%s=%d' % (priority.name.lower(), limit)
+                      for priority, limit in _MAILBOX_LIMITS.items()))
+
+
+# Fork child processes after logging is configured but before any
+# thread is started (or any connection is opened); children then run
+# the rest of the initializers by themselves.
+_LEVEL_PROCESSES = cc.inits.Level.NORMAL + 5
+
+
+@cc.inits.init(_LEVEL_PROCESSES)
+def init_processes():
+    args = cc.statics.args
+    if args.processes < 0:
+        raise cc.Error('Could not set negative number of processes: %d' %
+                       args.processes)
+    if args.processes == 0:
+        return
+    # Listen before forking so that children know where to call back.
+    authkey = os.urandom(32)
+    cc.statics.actor_children = _Children(authkey)
+    # A pool that is broken when a child dies (rather than one that
+    # forks a replacement, which could not run the initializers again).
+    cc.statics.process_pool = concurrent.futures.ProcessPoolExecutor(
+        args.processes, mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_child_process,
+        initargs=(cc.statics.actor_children.address, authkey))
+    # The pool forks all children on the first submit; do it now.
+    cc.statics.process_pool.submit(int).result()
+    cc.statics.actor_children.start()
+
+
+@cc.inits.final
+def final_processes():
+    if hasattr(cc.statics, 'process_pool'):
+        cc.statics.process_pool.shutdown()
+        cc.statics.actor_children.close()
+
+
+def _init_child_process(address, authkey):
+    cc.statics.actor_parent = _Parent(address, authkey)
+    cc.inits.run_inits(after=_LEVEL_PROCESSES)
+
+
+def is_child_process():
+    '''True if we are in a child process running actors.'''
+    return hasattr(cc.statics, 'actor_parent')
+
+
+def call_in_parent(func, *args):
+    '''Call func(*args) in the parent process and return the result.
+
+    Use this in a child process to share the state of the parent, such
+    as its limiters.
+    '''
+    return cc.statics.actor_parent.call(func, *args)
+
+
+# Worker pools other than the default one.
+POOLS = ('meta', 'small', 'media')
+
+# The (only) pool of the asyncio runtime, as far as mailboxes are
+# concerned: the executor threads of cc.actor.aio.
+_AIO_POOL = 'aio'
+
+
+def _get_queue_depths():
+    depths = {('delayed',): cc.statics.delayed_messages.qsize()}
+    message_queues = getattr(cc.statics, 'message_queues', {})
+    for pool, message_queue in message_queues.items():
+        depths[(pool or 'default',)] = message_queue.qsize()
+    return depths
+
+
+_QUEUE_DEPTH = cc.metrics.gauge(
+    'cc_actor_queue_depth', 'Messages waiting in the queue of a pool.',
+    ('pool',), func=_get_queue_depths)
+_TASKS = cc.metrics.gauge(
+    'cc_actor_tasks', 'Messages queued, being processed, or delayed.',
+    func=lambda: cc.statics.actor_tasks.count)
+_MESSAGES = cc.metrics.counter(
+    'cc_actor_messages_total', 'Messages processed by actor and outcome.',
+    ('actor', 'outcome'))
+_MESSAGE_SECONDS = cc.metrics.histogram(
+    'cc_actor_message_seconds', 'Time to process a message.', ('actor',))
+_WORKER_SECONDS = cc.metrics.counter(
+    'cc_actor_worker_seconds_total', 'Time worker threads spent busy or idle.',
+    ('pool', 'state'))
+_MAILBOX = cc.metrics.gauge(
+    'cc_actor_mailbox', 'Messages queued by priority class.', ('priority',),
+    func=lambda: cc.statics.mailboxes.get_counts())
+_MAILBOX_OVERFLOWS = cc.metrics.counter(
+    'cc_actor_mailbox_overflows_total',
+    'Messages queued beyond the limit of a full mailbox rather than '
+    'blocking the sender.', ('priority',))
+
+
+def _record_message(message, outcome, seconds):
+    actor = message.func.__qualname__
+    _MESSAGES.inc(actor=actor, outcome=outcome)
+    _MESSAGE_SECONDS.observe(seconds, actor=actor)
 
 
 @cc.inits.init(cc.inits.Level.LATE)
 def init_threads():
+    if is_child_process():
+        # Messages are sent to (and run by) the parent process.
+        return
     args = cc.statics.args
-    if args.queue == 'fifo':
-        cc.statics.message_queue = queue.Queue()
+    cc.statics.actor_tasks = _Tasks()
+    cc.statics.delayed_messages = DelayedMessages(_enqueue_delayed)
+    threading.Thread(target=cc.statics.delayed_messages.run,
+                     name='delayed', daemon=True).start()
+    limits = _parse_mailbox_limits(args.mailbox_limit or ())
+    if args.runtime == 'asyncio':
+        # Messages run on cc.actor.aio's event loop instead.
+        cc.statics.mailboxes = _Mailboxes(limits, {_AIO_POOL: args.jobs})
+        return
+    if args.queue == 'priority' and args.queue_aging <= 0:
+        raise cc.Error('Could not set non-positive queue aging: %s' %
+                       args.queue_aging)
+    pool_sizes = [(None, args.jobs)]
+    pool_sizes.extend((pool, getattr(args, 'jobs_%s' % pool))
+                      for pool in POOLS)
+    pool_sizes = [(pool, num_threads) for pool, num_threads in pool_sizes
+                  if num_threads is not None]
+    for _, num_threads in pool_sizes:
+        if num_threads < 1:
+            raise cc.Error('Could not set non-positive number of threads: %d' %
+                           num_threads)
+    cc.statics.mailboxes = _Mailboxes(
+        limits, {pool or 'default': num_threads
+                 for pool, num_threads in pool_sizes})
+    cc.statics.message_queues = {}
+    for pool, num_threads in pool_sizes:
+        message_queue = _make_queue(args.queue, args.queue_aging)
+        cc.statics.message_queues[pool] = message_queue
+        prefix = 'thread' if pool is None else pool
+        for i in range(num_threads):
+            name = '%s-%02d' % (prefix, i + 1)
+            threading.Thread(target=thread_main, args=(message_queue, pool),
+                             name=name, daemon=True).start()
+    cc.statics.message_queue = cc.statics.message_queues[None]
+
+
+def _parse_mailbox_limits(specs):
+    limits = dict(_MAILBOX_LIMITS)
+    for spec in specs:
+        name, _, limit = spec.partition('=')
+        try:
+            priority = Priority[name.upper()]
+            limit = int(limit)
+        except (KeyError, ValueError):
+            raise cc.Error('Could not parse mailbox limit: %s' % spec)
+        if priority is Priority.CONTROL:
+            # Bookkeeping messages are what unblocks the others.
+            raise cc.Error('Could not limit mailbox of control messages')
+        limits[priority] = limit if limit > 0 else None
+    return limits
+
+
+def _make_queue(queue_type, aging):
+    if queue_type == 'priority':
+        return PriorityMessageQueue(aging)
+    elif queue_type == 'fifo':
+        return queue.Queue()
     else:
-        cc.statics.message_queue = queue.LifoQueue()
-    if args.jobs < 1:
-        raise cc.Error('Could not set non-positive number of threads: %d',
-                       args.jobs)
-    for i in range(args.jobs):
-        name = 'thread-%02d' % (i + 1)
-        threading.Thread(target=thread_main, name=name, daemon=True).start()
+        return queue.LifoQueue()
+
 
+class Priority(enum.IntEnum):
+    '''Priority class of messages (smaller is served first).'''
+    # Bookkeeping, such as Counter.countdown().
+    CONTROL = 0
+    # Fetching and resolving feeds, pages, and media.
+    METADATA = 1
+    # Downloading small files, such as captions.
+    SMALL = 2
+    # Downloading media.
+    BULK = 3
 
-class Message(collections.namedtuple('Message', 'obj func args kwargs')):
+
+# Default --mailbox-limit; control messages are never limited.
+_MAILBOX_LIMITS = collections.OrderedDict((
+    (Priority.METADATA, 1024),
+    (Priority.SMALL, 1024),
+    (Priority.BULK, 1024),
+))
+
+
+class Message(collections.namedtuple(
+        'Message',
+        'obj func args kwargs attempt priority pool use_process token '
+        'retry_state',
+        defaults=(0, Priority.METADATA, None, False, None, None))):
 
     def __str__(self):
         args_string = ', '.join(itertools.chain(
@@ -70,43 +299,560 @@ class Message(collections.namedtuple('Message', 'obj func args kwargs')):
 
     def process(self):
         if self.obj is None:
-            self.func(*self.args, **self.kwargs)
+            result = self.func(*self.args, **self.kwargs)
         else:
-            self.func(self.obj, *self.args, **self.kwargs)
+            result = self.func(self.obj, *self.args, **self.kwargs)
+        if inspect.iscoroutine(result):
+            # A coroutine actor outside the asyncio runtime.
+            _get_loop().run_until_complete(result)
+
+    def __reduce__(self):
+        # func is the wrapped function, which pickle cannot look up by
+        # name (the name is bound to the stub).
+        func = (self.func.__module__, self.func.__qualname__)
+        return (_make_message, (func,) + tuple(self[:1]) + tuple(self[2:]))
+
 
+def _make_message(func, *fields):
+    module_name, qualname = func
+    obj = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    obj = inspect.unwrap(obj)
+    return Message(fields[0], obj, *fields[1:])
+
+
+def actor(func=None, *, priority=Priority.METADATA, pool=None,
+          process=False, cancellable=True):
+    '''Wrap a function as an actor.
+
+    The actor runs on the worker pool of the given name (one of POOLS),
+    or on the default pool if that pool is not enabled.  If process is
+    true, the worker thread passes the message to a child process (see
+    --processes); the arguments should be picklable then.  If
+    cancellable is true, the message is sent under the current
+    cancellation token (see cancellation()).
+    '''
+    if func is None:
+        return functools.partial(
+            actor, priority=priority, pool=pool, process=process,
+            cancellable=cancellable)
 
-def actor(func):
-    '''Wrap a function as an actor.'''
     @functools.wraps(func)
     def stub(*args, **kwargs):
-        cc.statics.message_queue.put(
-            Message(obj=None, func=func, args=args, kwargs=kwargs))
+        _send(Message(obj=None, func=func, args=args, kwargs=kwargs,
+                      priority=priority, pool=pool, use_process=process,
+                      token=_token.get() if cancellable else None))
     return stub
 
 
-def interface(method):
+def interface(method=None, *, priority=Priority.METADATA, pool=None,
+              process=False, cancellable=True):
     '''Wrap a method as an interface method of an actor.'''
+    if method is None:
+        return functools.partial(
+            interface, priority=priority, pool=pool, process=process,
+            cancellable=cancellable)
+
     @functools.wraps(method)
     def stub(self, *args, **kwargs):
-        cc.statics.message_queue.put(
-            Message(obj=self, func=method, args=args, kwargs=kwargs))
+        _send(Message(obj=self, func=method, args=args, kwargs=kwargs,
+                      priority=priority, pool=pool, use_process=process,
+                      token=_token.get() if cancellable else None))
     return stub
 
 
-def thread_main():
+class Cancelled(cc.Error):
+    '''Raised by code that stops because its token is cancelled.'''
+
+
+# Tokens of this process by id, so that a token is pickled (to a child
+# process) by reference, like cc.actor.counter.Counter.
+_tokens = weakref.WeakValueDictionary()
+_token_ids = itertools.count()
+
+
+class CancellationToken:
+    '''Cancel the messages sent under the token.
+
+    Queued messages of a cancelled token are dropped, and running ones
+    should check is_cancelled() (or check_cancelled()) and stop early.
+    Cancelling a token in a child process does not reach the parent,
+    and vice versa.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._id = next(_token_ids)
+        _tokens[self._id] = self
+
+    def __reduce__(self):
+        return (_get_token, (self._id,))
+
+    def cancel(self):
+        self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+
+def _get_token(token_id):
+    token = _tokens.get(token_id)
+    if token is None:
+        # We are in a child process; make a stand-in, which messages
+        # sent from here carry back to the real token.
+        token = CancellationToken.__new__(CancellationToken)
+        token._event = threading.Event()
+        token._id = token_id
+    return token
+
+
+# A context variable so that the current token follows asyncio tasks
+# and cc.actor.aio.run_blocking(), too.
+_token = contextvars.ContextVar('token', default=None)
+
+
+@contextlib.contextmanager
+def cancellation(token):
+    '''Send messages (and run code) under the token.'''
+    reset_token = _token.set(token)
+    try:
+        yield
+    finally:
+        _token.reset(reset_token)
+
+
+def is_cancelled():
+    '''True if the current token is cancelled.'''
+    token = _token.get()
+    return token is not None and token.is_cancelled()
+
+
+def check_cancelled():
+    '''Raise Cancelled if the current token is cancelled.'''
+    if is_cancelled():
+        raise Cancelled('cancelled')
+
+
+def _send(message):
+    if is_child_process():
+        # Forward the message as it is sent.
+        parent = cc.statics.actor_parent
+        parent.call(_send_from_child, message, *parent.worker)
+        return
+    cc.statics.actor_tasks.add()
+    cc.statics.mailboxes.acquire(
+        message.priority, _get_pool_name(message),
+        getattr(_worker, 'pool', None), getattr(_worker, 'may_block', True))
+    _enqueue(message)
+
+
+def _send_from_child(message, worker_pool, may_block):
+    # Send it as the worker thread that waits for the child would.
+    _init_worker(worker_pool, may_block)
+    _send(message)
+
+
+def _enqueue_delayed(message):
+    # The delayed thread must not block (or no other delayed message
+    # would be put), and the message was admitted once anyway.
+    cc.statics.mailboxes.acquire(
+        message.priority, _get_pool_name(message), may_block=False)
+    _enqueue(message)
+
+
+def _enqueue(message):
+    if hasattr(cc.statics, 'aio_runtime'):
+        cc.statics.aio_runtime.put(message)
+        return
+    message_queues = cc.statics.message_queues
+    message_queues.get(message.pool, message_queues[None]).put(message)
+
+
+def _get_pool_name(message):
+    '''Return the name of the pool that will run the message.'''
+    if hasattr(cc.statics, 'aio_runtime'):
+        return _AIO_POOL
+    if message.pool is not None and message.pool in cc.statics.message_queues:
+        return message.pool
+    return 'default'
+
+
+# What the current thread is to the mailboxes: the name of its pool if
+# it is a worker thread, and whether it may block at all.
+_worker = threading.local()
+
+
+def _init_worker(pool=None, may_block=True):
+    _worker.pool = pool
+    _worker.may_block = may_block
+
+
+def _get_loop():
+    '''Return the event loop of the current thread for coroutine actors
+    outside the asyncio runtime (one per thread rather than per message).
+    '''
+    loop = getattr(_worker, 'loop', None)
+    if loop is None:
+        loop = _worker.loop = asyncio.new_event_loop()
+    return loop
+
+
+class _Children:
+    '''Serve calls of child processes (see call_in_parent()).
+
+    Each thread of a child process connects to us, and is served by a
+    thread of its own.
+    '''
+
+    def __init__(self, authkey):
+        self._listener = multiprocessing.connection.Listener(
+            authkey=authkey)
+        self.address = self._listener.address
+
+    def start(self):
+        threading.Thread(target=self._accept, name='children',
+                         daemon=True).start()
+
+    def close(self):
+        self._listener.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except multiprocessing.AuthenticationError:
+                logging.warning('actor: reject connection', exc_info=True)
+                continue
+            except OSError:
+                return  # We are closed.
+            threading.Thread(target=self._serve, args=(connection,),
+                             name='child', daemon=True).start()
+
+    @staticmethod
+    def _serve(connection):
+        with connection:
+            while True:
+                try:
+                    func, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (True, func(*args))
+                except Exception as exc:
+                    reply = (False, _make_picklable(exc))
+                connection.send(reply)
+
+
+class _Parent:
+    '''The parent process, as seen from a child process.'''
+
+    def __init__(self, address, authkey):
+        self._address = address
+        self._authkey = authkey
+        self._local = threading.local()
+        # (pool, may_block) of the worker thread of the parent that waits
+        # for the message being processed (one at a time) by us.
+        self.worker = (None, True)
+
+    def call(self, func, *args):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = (
+                multiprocessing.connection.Client(
+                    self._address, authkey=self._authkey))
+        connection.send((func, args))
+        is_ok, result = connection.recv()
+        if not is_ok:
+            raise result
+        return result
+
+
+class _Tasks:
+    '''Count messages that are queued, being processed, or delayed.'''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._count = 0
+
+    @property
+    def count(self):
+        with self._cond:
+            return self._count
+
+    def add(self):
+        with self._cond:
+            self._count += 1
+
+    def done(self):
+        with self._cond:
+            self._count -= 1
+            if self._count == 0:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._count:
+                self._cond.wait()
+
+
+class _Mailboxes:
+    '''Bound the number of queued messages of each priority class.
+
+    A sender is blocked while the mailbox of the class is full, until a
+    worker takes a message of the class out of its queue.  But a worker
+    thread (which sends follow-up messages) is not blocked if then no
+    one would be left to take messages out of the receiving pool; the
+    message overflows the mailbox instead.  So does a message sent from
+    a thread that may not block, such as the event loop thread of
+    cc.actor.aio.
+    '''
+
+    def __init__(self, limits, pool_sizes):
+        self._limits = limits
+        self._pool_sizes = pool_sizes
+        self._cond = threading.Condition()
+        self._counts = collections.Counter()
+        # Number of blocked workers by (their pool, receiving pool).
+        self._blocked = collections.Counter()
+
+    def get_counts(self):
+        with self._cond:
+            return {(priority.name.lower(),): self._counts[priority]
+                    for priority in Priority}
+
+    def acquire(self, priority, pool, worker_pool=None, may_block=True):
+        '''Wait for room for a message to the pool.'''
+        limit = self._limits.get(priority)
+        with self._cond:
+            while limit is not None and self._counts[priority] >= limit:
+                if not may_block or not self._is_live(pool, worker_pool):
+                    _MAILBOX_OVERFLOWS.inc(priority=priority.name.lower())
+                    break
+                self._wait(pool, worker_pool)
+            self._counts[priority] += 1
+
+    def release(self, priority):
+        '''Call when a message is taken out of the queue.'''
+        with self._cond:
+            self._counts[priority] -= 1
+            self._cond.notify_all()
+
+    def _is_live(self, pool, worker_pool):
+        '''True if the pool would still make progress should the worker
+        be blocked on it.
+        '''
+        if worker_pool is None:
+            # Not a worker; it does not stop anyone from making progress.
+            return True
+        blocked = self._blocked.copy()
+        blocked[worker_pool, pool] += 1
+        # A pool is live if some of its workers are not blocked, or are
+        # blocked on a live pool.
+        live = set()
+        while True:
+            num_live = len(live)
+            for this_pool, size in self._pool_sizes.items():
+                num_blocked = sum(n for (p, _), n in blocked.items()
+                                  if p == this_pool)
+                if num_blocked < size or any(
+                        n and p == this_pool and q in live
+                        for (p, q), n in blocked.items()):
+                    live.add(this_pool)
+            if len(live) == num_live:
+                return pool in live
+
+    def _wait(self, pool, worker_pool):
+        if worker_pool is None:
+            self._cond.wait()
+            return
+        self._blocked[worker_pool, pool] += 1
+        # Let other blocked workers check whether they still should be.
+        self._cond.notify_all()
+        try:
+            self._cond.wait()
+        finally:
+            self._blocked[worker_pool, pool] -= 1
+
+
+class PriorityMessageQueue(queue.Queue):
+    '''Serve messages by priority class, and FIFO within a class.
+
+    To prevent starvation, a waiting message is promoted by one class
+    for every `aging` seconds it waits.
+    '''
+
+    def __init__(self, aging):
+        self.aging = aging
+        super().__init__()
+
+    # Override queue.Queue's internal methods, which are called with
+    # the queue's mutex held.
+
+    def _init(self, maxsize):
+        self._queues = collections.OrderedDict(
+            (priority, collections.deque()) for priority in Priority)
+        self._size = 0
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, message):
+        self._queues[message.priority].append((time.monotonic(), message))
+        self._size += 1
+
+    def _get(self):
+        now = time.monotonic()
+        best_queue = None
+        best_priority = None
+        for priority, messages in self._queues.items():
+            if not messages:
+                continue
+            # Only the head of a class is the oldest message of it.
+            effective = priority - (now - messages[0][0]) / self.aging
+            if best_queue is None or effective < best_priority:
+                best_queue, best_priority = messages, effective
+        self._size -= 1
+        return best_queue.popleft()[1]
+
+
+class DelayedMessages:
+    '''Put messages into the message queue after a delay.'''
+
+    def __init__(self, put):
+        self._put = put
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+
+    def qsize(self):
+        with self._cond:
+            return len(self._heap)
+
+    def put(self, message, delay):
+        with self._cond:
+            heapq.heappush(
+                self._heap, (time.time() + delay, next(self._seq), message))
+            self._cond.notify_all()
+
+    def run(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due = self._heap[0][0] - time.time()
+                if due > 0:
+                    self._cond.wait(due)
+                    continue
+                _, _, message = heapq.heappop(self._heap)
+                self._put(message)
+                self._cond.notify_all()
+
+
+def thread_main(message_queue, pool=None):
     thread_name = threading.current_thread().name
+    pool = pool or 'default'
+    _init_worker(pool)
     logging.info('%s: start', thread_name)
     while True:
-        message = cc.statics.message_queue.get()
+        start = time.monotonic()
+        message = message_queue.get()
+        cc.statics.mailboxes.release(message.priority)
+        started = time.monotonic()
+        _WORKER_SECONDS.inc(started - start, pool=pool, state='idle')
         logging.trace('%s: %s', thread_name, message)
+        # A re-scheduled message is still a task.
+        is_done = True
+        outcome = 'done'
+        retry_state = message.retry_state or cc.retry.RetryState()
         try:
-            message.process()
+            with cc.retry.deferring(message.attempt, retry_state), \
+                    cancellation(message.token):
+                # Drop the message if it is cancelled while queued.
+                check_cancelled()
+                _process(message)
+        except cc.retry.RetryLater as exc:
+            outcome = 'retry'
+            # Re-schedule the message as the child process has left it.
+            message = getattr(exc, 'message', None) or message._replace(
+                retry_state=retry_state)
+            delay = cc.retry.get_delay(exc, message.attempt)
+            logging.info('%s: retry=%d delay=%.1f: %s',
+                         thread_name, message.attempt, delay, message)
+            cc.statics.delayed_messages.put(
+                message._replace(attempt=message.attempt + 1), delay)
+            is_done = False
+        except Cancelled:
+            outcome = 'cancelled'
+            logging.info('%s: cancelled: %s', thread_name, message)
         except Exception:
+            outcome = 'error'
             logging.exception('%s: %s', thread_name, message)
         finally:
-            cc.statics.message_queue.task_done()
+            seconds = time.monotonic() - started
+            _WORKER_SECONDS.inc(seconds, pool=pool, state='busy')
+            _record_message(message, outcome, seconds)
+            message_queue.task_done()
+            if is_done:
+                cc.statics.actor_tasks.done()
     logging.error('%s: exit (impossible!)', thread_name)
 
 
+def _process(message):
+    if not message.use_process or not hasattr(cc.statics, 'process_pool'):
+        message.process()
+        return
+    worker = (getattr(_worker, 'pool', None),
+              getattr(_worker, 'may_block', True))
+    try:
+        future = cc.statics.process_pool.submit(
+            _process_in_child, message, worker)
+    except concurrent.futures.process.BrokenProcessPool:
+        # A child has died; process the rest in the parent.
+        message.process()
+        return
+    try:
+        error, message = future.result()
+    except concurrent.futures.process.BrokenProcessPool:
+        raise cc.Error('Could not process in child process (it died): %s' %
+                       message)
+    if error is not None:
+        if isinstance(error, cc.retry.RetryLater):
+            error.message = message
+        raise error
+
+
+def _process_in_child(message, worker):
+    '''Return (error, message) to the parent.'''
+    cc.statics.actor_parent.worker = worker
+    retry_state = message.retry_state or cc.retry.RetryState()
+    try:
+        with cc.retry.deferring(message.attempt, retry_state), \
+                cancellation(message.token):
+            message.process()
+        error = None
+    except cc.retry.RetryLater as exc:
+        error = cc.retry.RetryLater(_make_picklable(exc.error),
+                                    exc.retry_after, exc.attempt)
+    except Exception as exc:
+        # The worker thread of the parent logs it.
+        error = _make_picklable(exc)
+    # The parent serves the metrics; pass on what we have recorded.
+    call_in_parent(cc.metrics.add_updates, cc.metrics.take_updates())
+    return error, message._replace(retry_state=retry_state)
+
+
+def _make_picklable(exc):
+    try:
+        pickle.dumps(exc)
+    except Exception:
+        return cc.Error('%s: %s' % (exc.__class__.__name__, exc))
+    return exc
+
+
 def join():
-    cc.statics.message_queue.join()
+    # Messages are sent only by the main thread (before join) or by
+    # messages being processed, and so when the count of tasks drops to
+    # zero, no more messages will be sent.
+    cc.statics.actor_tasks.join()
@@ -0,0 +1,185 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''The asyncio runtime of actors (--runtime asyncio).
+
+Messages run as tasks of one event loop rather than on --jobs worker
+threads.  A coroutine actor is awaited on the loop, and so it occupies
+no thread while waiting for the network or a subprocess; a plain actor
+runs in an executor of --jobs threads (which is also where coroutine
+actors offload blocking and cpu-heavy calls to, see run_blocking()).
+Blocking network calls of coroutine actors run in an executor of their
+own (see run_io()), so that they are not capped by --jobs.
+A message stays in its mailbox (see --mailbox-limit) until it is let
+in flight (see --aio-concurrency).
+'''
+
+__all__ = [
+    'Runtime',
+    'is_enabled',
+    'run_blocking',
+    'run_io',
+]
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import inspect
+import threading
+import time
+
+import cc
+import cc.actor
+import cc.inits
+import cc.retry
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--aio-concurrency', type=int, default=1024,
+        help='for the asyncio runtime, set max number of messages in '
+             'flight (default: %(default)s)')
+    parser.add_argument(
+        '--aio-io-threads', type=int, default=64,
+        help='for the asyncio runtime, set number of threads for blocking '
+             'network calls (default: %(default)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_runtime():
+    args = cc.statics.args
+    if args.runtime != 'asyncio' or cc.actor.is_child_process():
+        return
+    if args.aio_concurrency < 1:
+        raise cc.Error('Could not set non-positive concurrency: %d' %
+                       args.aio_concurrency)
+    if args.aio_io_threads < 1:
+        raise cc.Error('Could not set non-positive io threads: %d' %
+                       args.aio_io_threads)
+    cc.statics.aio_runtime = Runtime(
+        args.jobs, args.aio_concurrency, args.aio_io_threads)
+
+
+def is_enabled():
+    '''True if actors run on the asyncio runtime.'''
+    return hasattr(cc.statics, 'aio_runtime')
+
+
+async def run_blocking(func, *args, **kwargs):
+    '''Call a blocking function from a coroutine actor.
+
+    On the asyncio runtime, the function runs in the executor (with
+    context variables, such as the retry attempt, copied).  Otherwise
+    the coroutine actor has a thread (and a loop) to itself, and so we
+    just call it.
+    '''
+    if not is_enabled():
+        return func(*args, **kwargs)
+    return await _run_in_executor(
+        cc.statics.aio_runtime.executor, func, args, kwargs)
+
+
+async def run_io(func, *args, **kwargs):
+    '''Like run_blocking() but for a function that mostly waits for the
+    network, which runs in the io executor (of --aio-io-threads threads)
+    rather than taking one of the --jobs threads.
+    '''
+    if not is_enabled():
+        return func(*args, **kwargs)
+    return await _run_in_executor(
+        cc.statics.aio_runtime.io_executor, func, args, kwargs)
+
+
+async def _run_in_executor(executor, func, args, kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+class Runtime:
+
+    def __init__(self, num_threads, concurrency, num_io_threads):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            num_threads, thread_name_prefix='aio-worker',
+            initializer=cc.actor._init_worker,
+            initargs=(cc.actor._AIO_POOL,))
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            num_io_threads, thread_name_prefix='aio-io',
+            initializer=cc.actor._init_worker,
+            initargs=(cc.actor._AIO_POOL,))
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Keep references to the tasks until they are done.
+        self._tasks = set()
+        threading.Thread(target=self._run, name='aio', daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        # Coroutine actors send messages from the loop thread; blocking
+        # it on a full mailbox would block every message.
+        cc.actor._init_worker(may_block=False)
+        logging.info('aio: start')
+        self.loop.run_forever()
+
+    def put(self, message):
+        '''Schedule a message (from any thread).'''
+        self.loop.call_soon_threadsafe(self._spawn, message)
+
+    def _spawn(self, message):
+        task = self.loop.create_task(self._process(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, message):
+        async with self._semaphore:
+            cc.statics.mailboxes.release(message.priority)
+            logging.trace('aio: %s', message)
+            # A re-scheduled message is still a task.
+            is_done = True
+            outcome = 'done'
+            start = time.monotonic()
+            retry_state = message.retry_state or cc.retry.RetryState()
+            try:
+                with cc.retry.deferring(message.attempt, retry_state), \
+                        cc.actor.cancellation(message.token):
+                    cc.actor.check_cancelled()
+                    await self._call(message)
+            except cc.retry.RetryLater as exc:
+                outcome = 'retry'
+                message = getattr(exc, 'message', None) or message._replace(
+                    retry_state=retry_state)
+                delay = cc.retry.get_delay(exc, message.attempt)
+                logging.info('aio: retry=%d delay=%.1f: %s',
+                             message.attempt, delay, message)
+                cc.statics.delayed_messages.put(
+                    message._replace(attempt=message.attempt + 1), delay)
+                is_done = False
+            except cc.actor.Cancelled:
+                outcome = 'cancelled'
+                logging.info('aio: cancelled: %s', message)
+            except Exception:
+                outcome = 'error'
+                logging.exception('aio: %s', message)
+            finally:
+                cc.actor._record_message(
+                    message, outcome, time.monotonic() - start)
+                if is_done:
+                    cc.statics.actor_tasks.done()
+
+    @staticmethod
+    async def _call(message):
+        if not inspect.iscoroutinefunction(message.func):
+            await run_blocking(cc.actor._process, message)
+            return
+        if message.obj is None:
+            await message.func(*message.args, **message.kwargs)
+        else:
+            await message.func(message.obj, *message.args, **message.kwargs)
@@ -6,18 +6,38 @@
 
 __all__ = ['Counter']
 
+import itertools
 import threading
+import weakref
 
 import cc.actor
 
 
+# Counters of this process by id, so that a counter is pickled (to a
+# child process, see cc.actor --processes) by reference.
+_counters = weakref.WeakValueDictionary()
+_ids = itertools.count()
+
+
 class Counter:
+    '''Count down the messages of a job, or cancel them all.
+
+    Messages of the job should be sent under the counter's token (see
+    cc.actor.cancellation()), so that cancel() drops those still queued
+    and asks those running to stop.
+    '''
 
     def __init__(self, on_success, on_canceled):
         self._on_success = on_success
         self._on_canceled = on_canceled
         self._lock = threading.RLock()
         self._count = None
+        self.token = cc.actor.CancellationToken()
+        self._id = next(_ids)
+        _counters[self._id] = self
+
+    def __reduce__(self):
+        return (_get_counter, (self._id, self.token))
 
     @property
     def count(self):
@@ -31,7 +51,11 @@ class Counter:
             if self._count <= 0:
                 self._success_with_lock()
 
-    @cc.actor.interface
+    # Bookkeeping messages are not cancellable, or a cancelled counter
+    # would not hear of its own cancellation.
+
+    @cc.actor.interface(priority=cc.actor.Priority.CONTROL, pool='meta',
+                        cancellable=False)
     def countdown(self):
         with self._lock:
             if self._on_success is None:
@@ -45,11 +69,31 @@ class Counter:
         self._on_success = None
         self._on_canceled = None
 
-    @cc.actor.interface
     def cancel(self):
+        # Cancel the token right away, rather than when the message is
+        # processed, so that queued siblings are dropped sooner.
+        self.token.cancel()
+        self._cancel()
+
+    @cc.actor.interface(priority=cc.actor.Priority.CONTROL, pool='meta',
+                        cancellable=False)
+    def _cancel(self):
+        # The token of a stand-in is a stand-in, too.
+        self.token.cancel()
         with self._lock:
             if self._on_success is None:
                 return
             self._on_canceled()
             self._on_success = None
             self._on_canceled = None
+
+
+def _get_counter(counter_id, token):
+    counter = _counters.get(counter_id)
+    if counter is None:
+        # We are in a child process; make a stand-in whose interface
+        # messages are forwarded to (and run on) the real counter.
+        counter = Counter.__new__(Counter)
+        counter._id = counter_id
+        counter.token = token
+    return counter
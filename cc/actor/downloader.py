@@ -7,20 +7,32 @@
 __all__ = ['downloader']
 
 import functools
+import inspect
 import os
 import os.path
 import requests
 import shutil
 import tempfile
+import threading
+import time
 
 import cc
 import cc.actor
+import cc.actor.aio
 import cc.actor.counter
+import cc.catalog
 import cc.http
+import cc.httpdl
 import cc.inits
+import cc.mediacache
+import cc.memory
+import cc.metrics
+import cc.retry
 import cc.rtmp
 import cc.pformat
+import cc.rendition
 import cc.salvage
+import cc.sync
 
 from cc import logging
 
@@ -42,7 +54,11 @@ def init_argparser():
         help='ignore http error when download captions')
 
 
-@cc.actor.actor
+_EPISODES = cc.metrics.counter(
+    'cc_episodes_total', 'Episodes by outcome.', ('outcome',))
+
+
+@cc.actor.actor(pool='meta')
 def downloader(episode):
     '''Download an episode.'''
     _downloader(episode,
@@ -63,10 +79,22 @@ def _downloader(episode, output_dir_path, simulate, salvage_dirs):
                   cc.pformat.PrettyFormatter(episode.videos))
     # Check/make paths.
     dir_path = os.path.join(output_dir_path, episode.dir_name)
+    if cc.catalog.is_complete(episode.dir_name):
+        logging.info('downloader: skip: complete: %s', episode.dir_name)
+        _EPISODES.inc(outcome='skipped')
+        _record_sync(episode, True)
+        return
     if os.path.exists(dir_path):
+        # Downloaded before we kept a catalog (or without one).
         logging.info('downloader: skip: dir_path=%s', dir_path)
+        _EPISODES.inc(outcome='skipped')
+        _record_sync(episode, True)
         return
-    salvage = cc.salvage.Salvage(episode.dir_name, salvage_dirs)
+    # Partial files of failed (or cancelled) downloads are left in the
+    # temporary directories in output_dir_path; resume from them.
+    salvage = cc.salvage.Salvage(
+        episode.dir_name, salvage_dirs,
+        part_dirs=[] if simulate else [output_dir_path])
     if simulate:
         tmp_dir_path = os.path.join(
             output_dir_path, 'tmpXXXXXXXX-' + episode.dir_name)
@@ -75,32 +103,56 @@ def _downloader(episode, output_dir_path, simulate, salvage_dirs):
             suffix='-'+episode.dir_name, dir=output_dir_path)
     logging.debug('downloader: tmp_dir_path=%s', tmp_dir_path)
     # Construct actors.
+    pendings = []
     counter = cc.actor.counter.Counter(
         functools.partial(_downloader_success,
-                          episode.url,
+                          episode,
                           tmp_dir_path,
                           dir_path,
-                          simulate),
+                          simulate,
+                          salvage),
         functools.partial(_downloader_failed,
-                          episode.url))
-    dlers = _make_dlers(episode, tmp_dir_path, counter, simulate, salvage)
+                          episode,
+                          pendings))
+    dlers = _make_dlers(episode, tmp_dir_path, counter, simulate, salvage,
+                        pendings)
     counter.count = len(dlers)
-    # Start actors.
-    for dler in dlers:
-        dler()
+    # Start actors; when one of them fails, the counter drops the rest.
+    with cc.actor.cancellation(counter.token):
+        for dler in dlers:
+            dler()
 
 
-def _make_dlers(episode, tmp_dir_path, counter, simulate, salvage):
+def _make_dlers(episode, tmp_dir_path, counter, simulate, salvage,
+                pendings):
     dlers = []
     for dl, url, fne, ext in _get_dls(episode):
-        src_path = salvage.find(episode.dir_name, fne + ext)
+        # Record where the file is from, except placeholders.
+        source = None if dl is _unavailable else url
+        src_path = cc.catalog.find_file(episode.dir_name, fne + ext)
         if src_path is not None:
-            logging.debug('downloader: salvage: %s', src_path)
+            logging.debug('downloader: catalog: %s', src_path)
             dl, url = _dl_copy, src_path
+        else:
+            src_path = salvage.find(episode.dir_name, fne + ext)
+            if src_path is not None:
+                logging.debug('downloader: salvage: %s', src_path)
+                dl, url = _dl_copy, src_path
         if simulate:
-            dl = _dl_none
+            dl, source = _dl_none, None
+        if dl in (_dl_rtmp, _dl_http):
+            pending = _Pending()
+            pendings.append(pending)
+            part_path = salvage.find_part(episode.dir_name, fne + ext)
+            dl = functools.partial(_dl_media, dl, pending, part_path)
+            dler = _bulk_dler
+        else:
+            # Let captions and the like finish (and the episode commit)
+            # without waiting behind media downloads.
+            dler = _small_dler
         dlers.append(functools.partial(
-            _dler, dl, url, tmp_dir_path, fne, ext, counter))
+            dler, dl, url, tmp_dir_path, episode.dir_name, fne, ext, source,
+            counter))
     return dlers
 
 
@@ -109,8 +161,8 @@ def _get_dls(episode):
         yield _dl_url, episode.url, 'index', '.html'
     for video in episode.videos:
         if video.rtmps:
-            rtmp = max(video.rtmps, key=lambda r: r.width)
-            yield _dl_rtmp, rtmp.url, video.fne, rtmp.ext
+            rtmp = cc.rendition.select(video.rtmps)
+            yield _get_dl_media(rtmp.url), rtmp.url, video.fne, rtmp.ext
         else:
             logging.warning('content is unavailable: %s', video.page_url)
             yield _unavailable, video.page_url, video.fne, '.mp4.unavailable'
@@ -118,12 +170,25 @@ def _get_dls(episode):
             yield _dl_caption, caption.url, video.fne, caption.ext
 
 
-@cc.actor.actor
-def _dler(dl, url, dir_path, fne, ext, counter):
-    logging.debug(
-        'downloader: %s -> %s', url, os.path.join(dir_path, fne + ext))
+def _get_dl_media(url):
+    # Progressive renditions served over http(s) need no subprocess.
+    if url.startswith(('http://', 'https://')):
+        return _dl_http
+    return _dl_rtmp
+
+
+async def _dler(dl, url, dir_path, dir_name, fne, ext, source, counter):
+    path = os.path.join(dir_path, fne + ext)
+    logging.debug('downloader: %s -> %s', url, path)
     try:
-        dl(url, dir_path, fne, ext)
+        with cc.memory.stage('download'):
+            await _call_dl(dl, url, dir_path, fne, ext)
+        if source is not None:
+            await cc.actor.aio.run_blocking(
+                cc.catalog.record_file, dir_name, fne + ext, path, source)
+    except cc.retry.RetryLater:
+        # We will be re-scheduled; don't cancel the episode.
+        raise
     except:
         counter.cancel()
         raise
@@ -131,26 +196,63 @@ def _dler(dl, url, dir_path, fne, ext, counter):
         counter.countdown()
 
 
-def _downloader_success(episode_url, tmp_dir_path, dir_path, simulate):
+async def _call_dl(dl, *args):
+    if inspect.iscoroutinefunction(dl):
+        await dl(*args)
+    else:
+        await cc.actor.aio.run_blocking(dl, *args)
+
+
+_bulk_dler = cc.actor.actor(
+    priority=cc.actor.Priority.BULK, pool='media')(_dler)
+_small_dler = cc.actor.actor(
+    priority=cc.actor.Priority.SMALL, pool='small')(_dler)
+
+
+def _downloader_success(episode, tmp_dir_path, dir_path, simulate, salvage):
     logging.debug('downloader: %s -> %s', tmp_dir_path, dir_path)
     if not simulate:
         os.rename(tmp_dir_path, dir_path)
-    logging.info('downloader: success: episode.url=%s', episode_url)
+        salvage.remove_tmp_dirs()
+        cc.catalog.record_episode(episode.dir_name, dir_path)
+        _record_sync(episode, True)
+    logging.info('downloader: success: episode.url=%s', episode.url)
+    _EPISODES.inc(outcome='success')
+
+
+def _downloader_failed(episode, pendings):
+    logging.error('downloader: error: episode.url=%s', episode.url)
+    _EPISODES.inc(outcome='failed')
+    # Media downloads dropped (or being stopped) by the cancellation are
+    # no longer pending.
+    for pending in pendings:
+        pending.release()
+    # The resolved media might be stale; resolve them again next time.
+    for video in episode.videos:
+        if video.uri is not None:
+            cc.mediacache.invalidate(video.uri)
+    _record_sync(episode, False)
 
 
-def _downloader_failed(episode_url):
-    logging.error('downloader: error: episode.url=%s', episode_url)
+def _record_sync(episode, success):
+    sync_state = cc.sync.get_state()
+    if sync_state is None:
+        return
+    if success:
+        sync_state.record_success(episode)
+    else:
+        sync_state.record_failure(episode)
 
 
-def _dl_url(url, dir_path, fne, ext):
-    doc = cc.http.get_url(url)
+async def _dl_url(url, dir_path, fne, ext):
+    doc = await cc.http.async_get_url(url)
     with open(os.path.join(dir_path, fne + ext), 'w') as output:
         output.write(doc)
 
 
-def _dl_caption(url, dir_path, fne, ext):
+async def _dl_caption(url, dir_path, fne, ext):
     try:
-        _dl_url(url, dir_path, fne, ext)
+        await _dl_url(url, dir_path, fne, ext)
     except requests.exceptions.HTTPError:
         if cc.statics.args.ignore_caption_error:
             logging.warning('could not download caption %s to %s/%s%s',
@@ -163,8 +265,59 @@ def _dl_copy(src_path, dir_path, *_):
     shutil.copy2(src_path, dir_path)
 
 
-def _dl_rtmp(url, dir_path, fne, ext):
-    cc.rtmp.download(url, fne + ext, cwd=dir_path)
+async def _dl_rtmp(url, dir_path, fne, ext, part_path=None):
+    if part_path is not None:
+        await cc.actor.aio.run_blocking(
+            cc.salvage.take_part,
+            part_path, os.path.join(dir_path, fne + ext + '.part'))
+    if cc.actor.aio.is_enabled():
+        await cc.rtmp.async_download(url, fne + ext, cwd=dir_path)
+    else:
+        cc.rtmp.download(url, fne + ext, cwd=dir_path)
+
+
+async def _dl_http(url, dir_path, fne, ext, part_path=None):
+    await cc.actor.aio.run_io(
+        cc.httpdl.download, url, fne + ext, cwd=dir_path, part_path=part_path)
+
+
+async def _dl_media(dl, pending, part_path, url, dir_path, fne, ext):
+    # Feed the throughput meter of the adaptive rendition policy.
+    start = time.monotonic()
+    try:
+        await _call_dl(dl, url, dir_path, fne, ext, part_path)
+    except cc.retry.RetryLater:
+        # Still pending; we will be re-scheduled.
+        raise
+    except:
+        pending.release()
+        raise
+    pending.release()
+    if part_path is not None:
+        # We cannot tell how much of the file is transferred this time
+        # (cc.httpdl preallocates it).
+        return
+    cc.rendition.record_transfer(
+        os.path.getsize(os.path.join(dir_path, fne + ext)),
+        time.monotonic() - start)
+
+
+class _Pending:
+    '''Count a media download as pending (see cc.rendition) until it is
+    released, by either the download or the cancellation of the episode.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._is_released = False
+        cc.rendition.add_pending(1)
+
+    def release(self):
+        with self._lock:
+            if self._is_released:
+                return
+            self._is_released = True
+        cc.rendition.add_pending(-1)
 
 
 def _unavailable(url, dir_path, fne, ext):
@@ -7,6 +7,7 @@
 __all__ = ['starter']
 
 import datetime
+import functools
 import pickle
 import threading
 
@@ -16,6 +17,10 @@ import cc.actor.downloader
 import cc.episode
 import cc.feed
 import cc.inits
+import cc.memory
+import cc.planner
+import cc.resolver
+import cc.sync
 
 from cc import logging
 
@@ -36,7 +41,8 @@ def init_argparser():
         help='set end date (required, format: YYYY-MM-DD)')
     parser.add_argument(
         '--step', default='1m',
-        help='set date step size (default: %(default)s)')
+        help='set date step size, such as 1y6m, or "auto" to let the '
+             'planner split the range (default: %(default)s)')
     parser.add_argument(
         '--stash',
         help='store download job info to file')
@@ -71,6 +77,9 @@ def init_check_args():
 @cc.inits.init(cc.inits.Level.LATE)
 def init_stash():
     args = cc.statics.args
+    if cc.actor.is_child_process():
+        # Episodes are stashed by the parent process (see stash()).
+        return
     if args.stash is not None:
         if args.stash_append:
             cc.statics.pickle_file = open(args.stash, 'ab')
@@ -90,7 +99,7 @@ def final_stash():
         cc.statics.pickle_file.close()
 
 
-@cc.actor.actor
+@cc.actor.actor(pool='meta')
 def starter():
     '''Start the actor formation!'''
     args = cc.statics.args
@@ -98,14 +107,19 @@ def starter():
              args.unstash is not None,
              args.start,
              args.end,
-             args.step)
+             args.step,
+             args.resolver,
+             args.stash is not None)
 
 
-def _starter(show_url, is_unstashing, start, end, step):
+def _starter(show_url, is_unstashing, start, end, step,
+             resolver, is_stashing):
     logging.info('starter: show_url=%s', show_url)
     if is_unstashing:
         with cc.statics.pickle_lock:
             pickle_file = cc.statics.pickle_file
+            # downloader() blocks while the mailbox is full, and so we
+            # do not load the whole stash file into memory at once.
             try:
                 while True:
                     episode = pickle.load(pickle_file)
@@ -120,11 +134,29 @@ def _starter(show_url, is_unstashing, start, end, step):
                   '\n  start=%s'
                   '\n  end=%s',
                   feed.url, feed.videos_url, feed.start, feed.end)
-    for sub_feed in feed.replace_date_range(start, end, step):
+    sync_state = cc.sync.get_state()
+    if sync_state is not None and sync_state.watermark is not None:
+        if sync_state.watermark >= end:
+            logging.info('starter: up to date: watermark=%s',
+                         sync_state.watermark)
+            return
+        start = max(start, sync_state.watermark)
+        logging.info('starter: sync from %s', start)
+    if sync_state is not None:
+        feed.exclude(sync_state.seen_ids)
+    with cc.memory.stage('plan'):
+        sub_feeds = cc.planner.plan(feed, start, end, step)
+    if sync_state is not None:
+        sync_state.add_windows(sub_feed.start for sub_feed in sub_feeds)
+    if resolver == 'asyncio':
+        cc.resolver.resolve(
+            sub_feeds, functools.partial(_dispatch, is_stashing=is_stashing))
+        return
+    for sub_feed in sub_feeds:
         starter_helper(sub_feed)
 
 
-@cc.actor.actor
+@cc.actor.actor(pool='meta', process=True)
 def starter_helper(sub_feed):
     '''Retrieve episodes and pass them to downloader().'''
     args = cc.statics.args
@@ -133,9 +165,33 @@ def starter_helper(sub_feed):
 
 def _starter_helper(sub_feed, is_stashing):
     logging.info('starter_helper: sub_feed.url=%s', sub_feed.url)
-    for episode in cc.episode.Episode.make_episodes(sub_feed):
-        if is_stashing:
-            with cc.statics.pickle_lock:
-                pickle.dump(episode, cc.statics.pickle_file)
-        else:
-            cc.actor.downloader.downloader(episode)
+    # Resolve the video pages first (make_episodes() might release
+    # them).
+    failed_dates = sub_feed.failed_dates
+    # Episodes are dispatched as they are resolved; remember them on
+    # sub_feed so that a re-scheduled message does not dispatch them
+    # again.
+    for episode in cc.episode.Episode.make_episodes(
+            sub_feed, sub_feed.dispatched_dir_names):
+        _dispatch(episode, is_stashing)
+        sub_feed.dispatched_dir_names.add(episode.dir_name)
+    if cc.sync.get_state() is not None:
+        cc.sync.record_window(sub_feed.start, failed_dates)
+    if cc.memory.is_bounded():
+        sub_feed.release()
+
+
+def _dispatch(episode, is_stashing):
+    if cc.memory.is_bounded():
+        episode = episode.compact()
+    if is_stashing:
+        stash(episode)
+    else:
+        cc.actor.downloader.downloader(episode)
+
+
+@cc.actor.actor(priority=cc.actor.Priority.CONTROL, pool='meta')
+def stash(episode):
+    '''Write an episode to the stash file.'''
+    with cc.statics.pickle_lock:
+        pickle.dump(episode, cc.statics.pickle_file)
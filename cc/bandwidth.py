@@ -0,0 +1,223 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Shape bandwidth with token buckets (global and per host).
+
+Limits may be changed at runtime: edit the --bandwidth-config file and
+send SIGHUP to the process.  A rate of 0 means unlimited.
+'''
+
+__all__ = [
+    'TokenBucket',
+    'reserve',
+    'set_limit',
+    'throttle',
+]
+
+import re
+import signal
+import threading
+import time
+import urllib.parse
+
+import cc
+import cc.actor
+import cc.inits
+
+from cc import logging
+
+
+def _rate(rate_string):
+    '''Parse rate (bytes per second) of the form 123, 456K, or 7.8M.
+
+    Return None (unlimited) for a rate of 0.
+    '''
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([kKmMgG]?)', rate_string.strip())
+    if not match:
+        raise ValueError('Could not parse rate: %s' % rate_string)
+    unit = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    rate = int(float(match.group(1)) * unit[match.group(2).lower()])
+    return rate or None
+
+
+def _host_rate(host_rate_string):
+    host, _, rate_string = host_rate_string.partition('=')
+    return host, _rate(rate_string)
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--bandwidth-limit', type=_rate,
+        help='set global bandwidth limit in bytes per second '
+             '(K and M suffixes are accepted; 0 means unlimited)')
+    parser.add_argument(
+        '--bandwidth-host-limit', type=_host_rate, action='append',
+        default=[], metavar='HOST=RATE',
+        help='set bandwidth limit of a host')
+    parser.add_argument(
+        '--bandwidth-burst', type=float, default=2,
+        help='set burst size in seconds of transfer (default: %(default)s)')
+    parser.add_argument(
+        '--bandwidth-config',
+        help='read limits from file (one "HOST RATE" or "* RATE" per '
+             'line), and re-read it on SIGHUP')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_shaper():
+    if cc.actor.is_child_process():
+        # Use the buckets of the parent process (see reserve()).
+        return
+    args = cc.statics.args
+    cc.statics.bandwidth_shaper = _Shaper(args.bandwidth_burst)
+    cc.statics.bandwidth_reload = threading.Event()
+    # Fall back to the command line limits if the config file is bad.
+    limits = (_get_limits(args, args.bandwidth_config) or
+              _get_limits(args, None))
+    for host, rate in limits.items():
+        if rate is not None:
+            set_limit(host, rate)
+    if args.bandwidth_config is not None:
+        # Do not touch the buckets in the signal handler (it may run in
+        # the middle of reserve() in the main thread); reload them on
+        # the next reserve() instead.
+        signal.signal(signal.SIGHUP,
+                      lambda *_: cc.statics.bandwidth_reload.set())
+
+
+def _get_limits(args, config_path):
+    '''Return the limits of the command line overridden by those of the
+    config file (or None if the config file could not be read).
+    '''
+    limits = {None: args.bandwidth_limit}
+    limits.update(args.bandwidth_host_limit)
+    if config_path is None:
+        return limits
+    logging.info('bandwidth: load %s', config_path)
+    try:
+        with open(config_path) as config_file:
+            for line in config_file:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                host, rate_string = line.split()
+                limits[None if host == '*' else host] = _rate(rate_string)
+    except (OSError, ValueError):
+        logging.exception('bandwidth: could not load %s', config_path)
+        return None
+    return limits
+
+
+def _reload():
+    cc.statics.bandwidth_reload.clear()
+    args = cc.statics.args
+    limits = _get_limits(args, args.bandwidth_config)
+    if limits is None:
+        # Keep the current limits.
+        return
+    # Hosts that are no longer limited become unlimited.
+    for host in cc.statics.bandwidth_shaper.get_hosts():
+        limits.setdefault(host, None)
+    for host, rate in limits.items():
+        set_limit(host, rate)
+
+
+class TokenBucket:
+    '''Thread-safe token bucket; a rate of None (or 0) means unlimited.'''
+
+    def __init__(self, rate, burst):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0
+        self._timestamp = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst):
+        with self._lock:
+            self._refill()
+            self.rate = rate or None
+            self.burst = burst
+            if self.rate is not None:
+                self._tokens = min(self._tokens, burst)
+
+    def reserve(self, num_bytes):
+        '''Take num_bytes tokens and return how long the caller should
+        wait before using them (tokens can go into debt).
+        '''
+        with self._lock:
+            if self.rate is None:
+                return 0
+            self._refill()
+            self._tokens -= num_bytes
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._timestamp) * self.rate)
+        self._timestamp = now
+
+
+class _Shaper:
+
+    def __init__(self, burst_seconds):
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._global = TokenBucket(None, 0)
+        self._hosts = {}
+
+    def set_limit(self, host, rate):
+        burst = None if not rate else max(1, rate * self.burst_seconds)
+        with self._lock:
+            if host is None:
+                bucket = self._global
+            else:
+                bucket = self._hosts.get(host)
+                if bucket is None:
+                    bucket = self._hosts[host] = TokenBucket(None, 0)
+        bucket.set_rate(rate, burst)
+
+    def get_hosts(self):
+        with self._lock:
+            return list(self._hosts)
+
+    def reserve(self, host, num_bytes):
+        delay = self._global.reserve(num_bytes)
+        with self._lock:
+            bucket = self._hosts.get(host)
+        if bucket is not None:
+            delay = max(delay, bucket.reserve(num_bytes))
+        return delay
+
+
+def set_limit(host, rate):
+    '''Set rate limit of host (or the global limit if host is None).'''
+    logging.info('bandwidth: set limit: host=%s rate=%s', host or '*', rate)
+    cc.statics.bandwidth_shaper.set_limit(host, rate)
+
+
+def reserve(url, num_bytes):
+    '''Account num_bytes transferred from url, and return the delay.'''
+    if cc.actor.is_child_process():
+        return cc.actor.call_in_parent(reserve, url, num_bytes)
+    if cc.statics.bandwidth_reload.is_set():
+        _reload()
+    host = urllib.parse.urlparse(url).netloc
+    return cc.statics.bandwidth_shaper.reserve(host, num_bytes)
+
+
+def throttle(url, chunks):
+    '''Throttle an iterable of chunks transferred from url.'''
+    for chunk in chunks:
+        delay = reserve(url, len(chunk))
+        if delay > 0:
+            time.sleep(delay)
+        yield chunk
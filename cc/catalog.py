@@ -0,0 +1,213 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Catalog of downloaded files and completed episodes.
+
+The catalog (a sqlite file in the output directory) records every
+completed file with its size, sha1, and source uri, and every completed
+episode.  A later run skips completed episodes before resolving their
+media, and copies completed files of a failed episode (which are left
+in its temporary directory) rather than downloading them again.
+'''
+
+__all__ = [
+    'Catalog',
+    'File',
+    'find_file',
+    'is_complete',
+    'record_episode',
+    'record_file',
+]
+
+import collections
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+import cc
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--catalog',
+        help='set download catalog (sqlite) file '
+             '(default: OUTPUT/.catalog.sqlite)')
+    parser.add_argument(
+        '--no-catalog', action='store_true',
+        help='do not keep a download catalog')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_catalog():
+    args = cc.statics.args
+    if args.no_catalog or args.simulate:
+        return
+    path = args.catalog or os.path.join(args.output or os.getcwd(),
+                                        '.catalog.sqlite')
+    cc.statics.catalog = Catalog(path)
+
+
+@cc.inits.final
+def final_catalog():
+    if hasattr(cc.statics, 'catalog'):
+        cc.statics.catalog.close()
+
+
+def is_complete(dir_name):
+    '''True if the episode is downloaded completely (and its directory
+    still exists).
+    '''
+    if not hasattr(cc.statics, 'catalog'):
+        return False
+    return cc.statics.catalog.is_complete(dir_name)
+
+
+def find_file(dir_name, file_name):
+    '''Return the path of a completed file that still exists, or None.'''
+    if not hasattr(cc.statics, 'catalog'):
+        return None
+    return cc.statics.catalog.find_file(dir_name, file_name)
+
+
+def record_file(dir_name, file_name, path, uri):
+    if hasattr(cc.statics, 'catalog'):
+        cc.statics.catalog.record_file(dir_name, file_name, path, uri)
+
+
+def record_episode(dir_name, dir_path):
+    '''Record an episode completed and its files moved to dir_path.'''
+    if hasattr(cc.statics, 'catalog'):
+        cc.statics.catalog.record_episode(dir_name, dir_path)
+
+
+File = collections.namedtuple('File', 'path size sha1 uri')
+
+
+class Catalog:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                '  dir_name TEXT NOT NULL,'
+                '  file_name TEXT NOT NULL,'
+                '  path TEXT NOT NULL,'
+                '  size INTEGER NOT NULL,'
+                '  sha1 TEXT NOT NULL,'
+                '  uri TEXT,'
+                '  completed_at REAL NOT NULL,'
+                '  PRIMARY KEY (dir_name, file_name))')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS episodes ('
+                '  dir_name TEXT PRIMARY KEY,'
+                '  completed_at REAL NOT NULL,'
+                '  dir_path TEXT)')
+            # Catalogs created before we kept dir_path.
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(episodes)')]
+            if 'dir_path' not in columns:
+                conn.execute('ALTER TABLE episodes ADD COLUMN dir_path TEXT')
+            conn.commit()
+
+    def _connect(self):
+        # Do not share a connection with a forked process.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def is_complete(self, dir_name):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT dir_path FROM episodes WHERE dir_name = ?',
+                (dir_name,)).fetchone()
+            if row is None:
+                return False
+            dir_path, = row
+            # We cannot check rows recorded before we kept dir_path.
+            if dir_path is None or os.path.isdir(dir_path):
+                return True
+            logging.info('catalog: stale: %s', dir_path)
+            conn.execute('DELETE FROM episodes WHERE dir_name = ?',
+                         (dir_name,))
+            conn.execute('DELETE FROM files WHERE dir_name = ?',
+                         (dir_name,))
+            conn.commit()
+        return False
+
+    def get_file(self, dir_name, file_name):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT path, size, sha1, uri FROM files '
+                'WHERE dir_name = ? AND file_name = ?',
+                (dir_name, file_name)).fetchone()
+        return None if row is None else File(*row)
+
+    def find_file(self, dir_name, file_name):
+        entry = self.get_file(dir_name, file_name)
+        if entry is None:
+            return None
+        try:
+            size = os.path.getsize(entry.path)
+        except OSError:
+            size = None
+        if size != entry.size:
+            logging.debug('catalog: stale: %s', entry.path)
+            return None
+        return entry.path
+
+    def record_file(self, dir_name, file_name, path, uri):
+        size = os.path.getsize(path)
+        sha1 = _hash_file(path)
+        logging.debug('catalog: file: %s size=%d sha1=%s', path, size, sha1)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (dir_name, file_name, path, size, sha1, uri, time.time()))
+            conn.commit()
+
+    def record_episode(self, dir_name, dir_path):
+        logging.debug('catalog: episode: %s', dir_name)
+        with self._lock:
+            conn = self._connect()
+            for file_name, in conn.execute(
+                    'SELECT file_name FROM files WHERE dir_name = ?',
+                    (dir_name,)).fetchall():
+                conn.execute(
+                    'UPDATE files SET path = ? '
+                    'WHERE dir_name = ? AND file_name = ?',
+                    (os.path.join(dir_path, file_name), dir_name, file_name))
+            conn.execute(
+                'INSERT OR REPLACE INTO episodes VALUES (?, ?, ?)',
+                (dir_name, time.time(), os.path.abspath(dir_path)))
+            conn.commit()
+
+
+def _hash_file(path, chunk_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -4,33 +4,71 @@
 
 '''Representation of one episode.'''
 
-__all__ = ['Episode']
+__all__ = [
+    'Episode',
+    'make_dir_name',
+]
 
 import collections
 import re
 
 import cc
+import cc.catalog
+import cc.memory
 import cc.video
 
+from cc import logging
+
 
 class Episode(collections.namedtuple('Episode', 'url date dir_name videos')):
     '''One episode of the show.'''
 
     @staticmethod
-    def make_episodes(feed):
-        '''Select Video object from feed and group by (date, episode_url).'''
-        video_groups = collections.defaultdict(list)
-        for video in cc.video.Video.make_videos(feed):
-            video_groups[(video.date, video.episode_url)].append(video)
-        episodes = [Episode(url=episode_url,
-                            date=date,
-                            dir_name=_make_dir_name(episode_url, date),
-                            videos=videos)
-                    for (date, episode_url), videos in video_groups.items()]
-        return episodes
-
-
-def _make_dir_name(episode_url, date):
+    def make_episodes(feed, skip_dir_names=()):
+        '''Generate Episode objects of feed grouped by (date, episode_url).
+
+        Videos are grouped before their media are resolved, and so an
+        episode is generated as soon as its own videos are resolved.
+        Episodes of feed.failed_dates are left out since they might miss
+        a video.
+        '''
+        video_groups = collections.OrderedDict()
+        for video_blob, fne in cc.video.make_fnes(feed.video_blobs):
+            video_groups.setdefault(
+                (video_blob.date, video_blob.episode_url), []).append(
+                    (video_blob, fne))
+        failed_dates = feed.failed_dates
+        if cc.memory.is_bounded():
+            # Drop video blobs of feed; we have them in video_groups.
+            feed.release()
+        for (date, episode_url), group in video_groups.items():
+            dir_name = make_dir_name(episode_url, date)
+            if dir_name in skip_dir_names:
+                continue
+            if date in failed_dates:
+                logging.error('episode: incomplete: %s', dir_name)
+                continue
+            if cc.catalog.is_complete(dir_name):
+                logging.info('episode: skip: complete: %s', dir_name)
+                continue
+            videos = [cc.video.Video.resolve(feed.show_url, video_blob, fne)
+                      for video_blob, fne in group]
+            yield Episode.from_videos(date, episode_url, videos)
+
+    def compact(self):
+        '''Return a copy that keeps only what downloading it needs.'''
+        return self._replace(
+            videos=tuple(video.compact() for video in self.videos))
+
+    @staticmethod
+    def from_videos(date, episode_url, videos):
+        return Episode(url=episode_url,
+                       date=date,
+                       dir_name=make_dir_name(episode_url, date),
+                       videos=videos)
+
+
+def make_dir_name(episode_url, date):
     date_string = date.strftime('%Y-%m-%d')
     if episode_url is None:
         return date_string
@@ -4,21 +4,51 @@
 
 '''Representation of a (manifest) feed.'''
 
-__all__ = ['Feed']
+__all__ = [
+    'Feed',
+    'FeedVideo',
+    'VideoBlob',
+    'make_video_blob',
+]
 
+import calendar
 import collections
+import concurrent.futures
 import datetime
-import json
+import itertools
 import re
 import urllib.parse
 
 import cc
 import cc.http
+import cc.inits
+import cc.manifest
+import cc.memory
 import cc.pformat
+import cc.retry
 
 from cc import logging
 
 
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--feed-jobs', type=int, default=4,
+        help='set number of video pages fetched concurrently '
+             '(default: %(default)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_executor():
+    args = cc.statics.args
+    if args.feed_jobs < 1:
+        raise cc.Error('Could not set non-positive number of feed jobs: %d' %
+                       args.feed_jobs)
+    cc.statics.feed_executor = concurrent.futures.ThreadPoolExecutor(
+        args.feed_jobs)
+
+
 class Feed:
     '''The (manifest) feed of the show within a date range.'''
 
@@ -43,6 +73,17 @@ class Feed:
         self._end = end
         self._feed = None
         self._video_blobs = None
+        # Video blobs resolved so far (index -> VideoBlob).
+        self._resolved_video_blobs = {}
+        # Dates of videos whose pages could not be resolved.
+        self._failed_dates = set()
+        self._excluded_ids = frozenset()
+        # Episodes of this feed handed to downloader() so far.
+        self.dispatched_dir_names = set()
+
+    def exclude(self, video_ids):
+        '''Leave out videos of the given ids (before fetching pages).'''
+        self._excluded_ids = frozenset(video_ids)
 
     def replace_date_range(self, start, end, step=None):
         if step is None:
@@ -54,37 +95,57 @@ class Feed:
                 steps[unit] = int(match.group(1))
         if all(v == 0 for v in steps.values()):
             raise cc.Error('date step is zero: %s' % step)
+        months = steps['y'] * 12 + steps['m']
         feeds = []
         date = start
-        while date < end:
-            # Very naive date calculation.
-            next_year = date.year + steps['y']
-            next_month = date.month + steps['m']
-            if next_month > 12:
-                next_year += (next_month - 1) // 12
-                next_month %= 12
-                if next_month == 0:
-                    next_month = 12
-            next_date = date.replace(next_year, next_month)
-            next_date = min(next_date, end)
+        for i in itertools.count(1):
+            if date >= end:
+                break
+            # Step from start (rather than from date) so that clamping
+            # the day of month (say, Jan 31 -> Feb 28) does not drift.
+            next_date = min(_add_months(start, months * i), end)
             feeds.append(self._replace_date_range(date, next_date))
             date = next_date
         return feeds
 
+    def bisect(self):
+        '''Split the date range in halves.'''
+        middle = self.start + (self.end - self.start) / 2
+        middle = middle.replace(microsecond=0)
+        return (self._replace_date_range(self.start, middle),
+                self._replace_date_range(middle, self.end))
+
+    @staticmethod
+    def merge(feeds):
+        '''Merge consecutive feeds (whose documents are fetched).'''
+        if len(feeds) == 1:
+            return feeds[0]
+        merged = feeds[0]._replace_date_range(feeds[0].start, feeds[-1].end)
+        merged._feed = {'result': {'videos': [
+            video for feed in feeds for video in feed.feed['result']['videos']
+        ]}}
+        return merged
+
     def _replace_date_range(self, start, end):
         match = re.fullmatch(r'(.*)/(\d+)/(\d+)', self.url)
         if not match:
             raise cc.Error('feed.url has no date: %s' % self.url)
         url = ('%s/%s/%s' %
                (match.group(1), int(start.timestamp()), int(end.timestamp())))
-        return Feed(self.show_url, self.videos_url, url, start, end)
+        feed = Feed(self.show_url, self.videos_url, url, start, end)
+        feed._excluded_ids = self._excluded_ids
+        return feed
+
+    @property
+    def num_videos(self):
+        return len(self.feed['result']['videos'])
 
     @property
     def url(self):
         if self._url is None:
             props = ('manifest', 'zones', 't6_lc_promo1', 'feed')
             doc = cc.http.get_url(self.videos_url)
-            self._url = _get_manifest_feed_property(doc, props)
+            self._url = cc.manifest.get_property(doc, props)
         return self._url
 
     @property
@@ -109,34 +170,134 @@ class Feed:
     @property
     def feed(self):
         if self._feed is None:
-            self._feed = cc.http.get_url_json(self.url)
-            logging.trace('feed.feed=\n%s',
-                          cc.pformat.PrettyFormatter(self._feed))
+            with cc.memory.stage('feed'):
+                self._feed = cc.http.get_url_json(self.url)
+                logging.trace('feed.feed=\n%s',
+                              cc.pformat.PrettyFormatter(self._feed))
+                if cc.memory.is_bounded():
+                    self._feed = _compact_feed(self._feed)
         return self._feed
 
+    @property
+    def videos(self):
+        '''List FeedVideo entries of the feed (without fetching pages).'''
+        feed_videos = [_make_feed_video(video)
+                       for video in self.feed['result']['videos']]
+        return [feed_video for feed_video in feed_videos
+                if feed_video.id not in self._excluded_ids]
+
     @property
     def video_blobs(self):
         if self._video_blobs is None:
-            self._video_blobs = []
-            for video in self.feed['result']['videos']:
-                page_url = video['canonicalURL']
-                logging.debug('video_blobs: page_url=%s', page_url)
-                # Zero out time part of datetime object.
-                date = datetime.datetime.fromtimestamp(int(video['airDate']))
-                date = datetime.datetime(date.year, date.month, date.day)
-                page_doc = cc.http.get_url(page_url)
-                self._video_blobs.append(VideoBlob(
-                    uri=_get_uri(page_doc, video['id']),
-                    page_url=page_url,
-                    episode_url=_get_episode_url(page_doc),
-                    date=date))
+            with cc.memory.stage('video_blobs'):
+                self._video_blobs = self._resolve_video_blobs()
+            self._resolved_video_blobs = {}
+            if cc.memory.is_bounded():
+                # We are done with the feed document.
+                self._feed = None
         return self._video_blobs
 
+    @property
+    def failed_dates(self):
+        '''Dates of videos whose pages could not be resolved.
+
+        We do not know which episodes those videos belong to (it is on
+        their pages), and so no episode of these dates is complete.
+        '''
+        self.video_blobs
+        return frozenset(self._failed_dates)
+
+    def release(self):
+        '''Drop documents and video blobs (they are fetched again if
+        accessed later).
+        '''
+        self._feed = None
+        self._video_blobs = None
+        self._resolved_video_blobs = {}
+        self._failed_dates = set()
+
+    def _resolve_video_blobs(self):
+        '''Fetch video pages concurrently.
+
+        A page that could not be resolved is logged and skipped, and
+        its date is added to failed_dates.  If some pages should be
+        retried later, RetryLater is re-raised after the rest are done,
+        and the next call resumes from there.
+        '''
+        feed_videos = self.videos
+        attempt = cc.retry.current_attempt()
+        retry_state = cc.retry.current_state()
+        futures = [
+            (index, feed_video, cc.statics.feed_executor.submit(
+                _fetch_video_blob, feed_video, attempt, retry_state))
+            for index, feed_video in enumerate(feed_videos)
+            if index not in self._resolved_video_blobs]
+        retry_later = None
+        for index, feed_video, future in futures:
+            try:
+                self._resolved_video_blobs[index] = future.result()
+            except cc.retry.RetryLater as exc:
+                retry_later = exc
+            except Exception:
+                logging.exception('video_blobs: page_url=%s',
+                                  feed_video.page_url)
+                self._failed_dates.add(feed_video.date)
+        if retry_later is not None:
+            raise retry_later
+        return [self._resolved_video_blobs[index]
+                for index in range(len(feed_videos))
+                if index in self._resolved_video_blobs]
+
+
+def _fetch_video_blob(feed_video, attempt, retry_state):
+    # Run as if we are the calling actor message.
+    with cc.retry.deferring(attempt, retry_state):
+        logging.debug('video_blobs: page_url=%s', feed_video.page_url)
+        page_doc = cc.http.get_url(feed_video.page_url)
+        return make_video_blob(feed_video, page_doc)
+
+
+# Fields of feed['result']['videos'][i] that we use.
+_VIDEO_KEYS = ('id', 'canonicalURL', 'airDate')
+
+
+def _compact_feed(feed):
+    return {'result': {'videos': [
+        {key: video[key] for key in _VIDEO_KEYS}
+        for video in feed['result']['videos']
+    ]}}
+
+
+def _add_months(date, months):
+    month_index = date.month - 1 + months
+    year = date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+FeedVideo = collections.namedtuple('FeedVideo', 'id page_url date')
+
+
+def _make_feed_video(video):
+    # Zero out time part of datetime object.
+    date = datetime.datetime.fromtimestamp(int(video['airDate']))
+    date = datetime.datetime(date.year, date.month, date.day)
+    return FeedVideo(id=video['id'], page_url=video['canonicalURL'], date=date)
+
 
 VideoBlob = collections.namedtuple(
     'VideoBlob', 'uri page_url episode_url date')
 
 
+def make_video_blob(feed_video, page_doc):
+    '''Make VideoBlob from a feed entry and its video page.'''
+    return VideoBlob(uri=_get_uri(page_doc, feed_video.id),
+                     page_url=feed_video.page_url,
+                     episode_url=_get_episode_url(page_doc),
+                     date=feed_video.date)
+
+
 # uri format: mgid:arc:video:HOST_NAME:UUID
 _PATTERN_URI = re.compile(
     r'(mgid:arc:video:'
@@ -156,23 +317,6 @@ def _get_episode_url(video_page_doc):
     props = ('manifest', 'zones', 't4_lc_promo1', 'feedData', 'result',
              'episode', 'canonicalURL')
     try:
-        return _get_manifest_feed_property(video_page_doc, props)
+        return cc.manifest.get_property(video_page_doc, props)
     except (KeyError, cc.Error):
         return None
-
-
-_PATTERN_MANIFEST_FEED = re.compile(r'var triforceManifestFeed = (.*);')
-
-
-def _get_manifest_feed_property(manifest_feed_doc, property_names):
-    '''Extract triforceManifestFeed from doc and read the nested property.'''
-    match = _PATTERN_MANIFEST_FEED.search(manifest_feed_doc)
-    if not match:
-        raise cc.Error('Could not find manifest feed')
-    manifest_feed = json.loads(match.group(1))
-    logging.trace('triforceManifestFeed=\n%s',
-                  cc.pformat.PrettyFormatter(manifest_feed))
-    blob = manifest_feed
-    for property_name in property_names:
-        blob = blob[property_name]
-    return blob
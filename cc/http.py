@@ -5,50 +5,559 @@
 '''Download documents through http.'''
 
 __all__ = [
+    'async_get_url',
+    'async_get_url_bytes',
+    'async_get_url_json',
     'get_url',
     'get_url_bytes',
-    'get_url_dom_tree'
     'get_url_json',
+    'get_url_xml_elements',
+    'iter_content',
+    'open_url',
 ]
 
+import collections
+import contextlib
+import functools
+import io
+import itertools
+import re
+import tempfile
+import threading
 import time
+import urllib.parse
 
 import lxml.etree
 import requests
+import requests.adapters
+import requests.structures
+
+import cc
+import cc.actor
+import cc.actor.aio
+import cc.bandwidth
+import cc.httpcache
+import cc.inits
+import cc.memory
+import cc.metrics
+import cc.retry
 
 from cc import logging
 
 
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--http-pool-size', type=int, default=16,
+        help='set number of pooled connections per host '
+             '(default: %(default)s)')
+    # Comedy Central seems to limit concurrent connections to 6 (see
+    # also cc.actor); so we cap the number of in-flight requests per
+    # host no matter how large --jobs is.
+    parser.add_argument(
+        '--http-host-limit', type=int, default=6,
+        help='set max concurrent requests per host (default: %(default)s)')
+    parser.add_argument(
+        '--http-cache',
+        help='cache http responses in this directory')
+    parser.add_argument(
+        '--http-cache-size', type=int, default=1024,
+        help='set http cache size in megabytes (default: %(default)s)')
+    parser.add_argument(
+        '--http-cache-ttl', action='append', default=[],
+        metavar='CLASS=SECONDS',
+        help='set time-to-live of a url class, where CLASS is one of %s; '
+             'negative SECONDS means never expire' % ', '.join(_DEFAULT_TTLS))
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_session():
+    args = cc.statics.args
+    if args.http_pool_size < 1:
+        raise cc.Error('Could not set non-positive pool size: %d' %
+                       args.http_pool_size)
+    if args.http_host_limit < 1:
+        raise cc.Error('Could not set non-positive host limit: %d' %
+                       args.http_host_limit)
+    cc.statics.http_session = _make_session(args.http_pool_size)
+    if cc.actor.is_child_process():
+        # Share the per-host caps with the parent process.
+        cc.statics.http_host_limiter = _ParentHostLimiter()
+    else:
+        cc.statics.http_host_limiter = _HostLimiter(args.http_host_limit)
+    cc.statics.http_single_flight = _SingleFlight()
+    cc.statics.http_breaker = cc.retry.CircuitBreaker(
+        args.breaker_threshold, args.breaker_cooldown)
+    if args.http_cache is not None:
+        cc.statics.http_cache = cc.httpcache.Cache(
+            args.http_cache, args.http_cache_size * 1024 * 1024)
+        cc.statics.http_cache_ttls = _parse_ttls(args.http_cache_ttl)
+
+
+# Time-to-live (in seconds) of each url class; None means never expire.
+_DEFAULT_TTLS = collections.OrderedDict([
+    # A feed window that ends in the past is effectively immutable.
+    ('past-feed', None),
+    ('feed', 60 * 60),
+    ('mrss', 24 * 60 * 60),
+    ('mediagen', 24 * 60 * 60),
+    ('page', 24 * 60 * 60),
+])
+
+
+def _parse_ttls(ttl_strings):
+    ttls = dict(_DEFAULT_TTLS)
+    for ttl_string in ttl_strings:
+        url_class, _, seconds = ttl_string.partition('=')
+        if url_class not in ttls:
+            raise cc.Error('Unknown url class: %s' % url_class)
+        try:
+            seconds = int(seconds)
+        except ValueError:
+            raise cc.Error('Could not parse ttl: %s' % ttl_string)
+        ttls[url_class] = seconds if seconds >= 0 else None
+    return ttls
+
+
+_PATTERN_FEED_DATES = re.compile(r'/(\d+)/(\d+)$')
+
+
+def _classify_url(url, now=None):
+    path = urllib.parse.urlparse(url).path
+    match = _PATTERN_FEED_DATES.search(path)
+    if match:
+        # Leave the server one day of slack to publish late episodes.
+        if int(match.group(2)) < (now or time.time()) - 24 * 60 * 60:
+            return 'past-feed'
+        return 'feed'
+    if 'mrss' in path:
+        return 'mrss'
+    if 'mediagen' in url:
+        return 'mediagen'
+    return 'page'
+
+
+_REQUESTS = cc.metrics.counter(
+    'cc_http_requests_total', 'HTTP requests by host and status code.',
+    ('host', 'status'))
+_REQUEST_SECONDS = cc.metrics.histogram(
+    'cc_http_request_seconds', 'Time to receive HTTP response headers.',
+    ('host',))
+_CACHE_HITS = cc.metrics.counter(
+    'cc_http_cache_hits_total', 'Responses served from the http cache.')
+_COALESCED = cc.metrics.counter(
+    'cc_http_coalesced_fetches_total',
+    'Fetches coalesced into in-flight ones.')
+
+
+@cc.inits.final
+def final_session():
+    logging.info('http: coalesced fetches: %d',
+                 cc.statics.http_single_flight.num_coalesced)
+    logging.debug('final_session: close http session')
+    cc.statics.http_session.close()
+
+
+def _make_session(pool_size):
+    # requests.Session is safe to share among threads as long as we do
+    # not mutate it after construction; urllib3's connection pool (with
+    # pool_block) does the locking for us.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size,
+                                            pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _HostLimiter:
+    '''Cap the number of concurrent requests to a host.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = collections.defaultdict(
+            lambda: threading.BoundedSemaphore(self.limit))
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def acquire(self, url):
+        self._get_semaphore(url).acquire()
+
+    def release(self, url):
+        self._get_semaphore(url).release()
+
+    def _get_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            return self._semaphores[host]
+
+
+class _ParentHostLimiter:
+    '''Hold slots of the host limiter of the parent process.'''
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        cc.actor.call_in_parent(_acquire_host, url)
+        try:
+            yield
+        finally:
+            cc.actor.call_in_parent(_release_host, url)
+
+
+def _acquire_host(url):
+    cc.statics.http_host_limiter.acquire(url)
+
+
+def _release_host(url):
+    cc.statics.http_host_limiter.release(url)
+
+
+class _SingleFlight:
+    '''Coalesce concurrent calls of the same key into one.'''
+
+    class _Call:
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.num_coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.num_coalesced += 1
+                _COALESCED.inc()
+                is_leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                is_leader = True
+        if not is_leader:
+            logging.trace('single-flight: wait for %s', key)
+            call.event.wait()
+            if isinstance(call.error, cc.retry.RetryLater):
+                # Give each waiter its own copy, to handle by its own
+                # retry policy (see _get_url_with_retry).
+                raise cc.retry.RetryLater(
+                    call.error.error, call.error.retry_after)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key)
+            call.event.set()
+        return call.result
+
+
 def get_url(url):
-    return _get_url_with_retry(url).text
+    return _get_shared_response(url).text
 
 
 def get_url_bytes(url):
-    return _get_url_with_retry(url).content
+    return _get_shared_response(url).content
+
 
+def get_url_json(url):
+    return _get_shared_response(url).json()
 
-def get_url_dom_tree(url):
-    return lxml.etree.fromstring(get_url_bytes(url))
 
+# Versions for coroutines; the (blocking) fetching and parsing run in
+# the executor of the asyncio runtime.
+
+
+async def async_get_url(url):
+    return await cc.actor.aio.run_io(get_url, url)
+
+
+async def async_get_url_bytes(url):
+    return await cc.actor.aio.run_io(get_url_bytes, url)
+
+
+async def async_get_url_json(url):
+    return await cc.actor.aio.run_io(get_url_json, url)
+
+
+def _get_shared_response(url):
+    '''Fetch url, sharing the response with concurrent fetches of it.'''
+    # A re-run of the calling work does not fetch it again.
+    state = cc.retry.current_state()
+    if state is not None:
+        response = state.get_result(url)
+        if response is not None:
+            return response
+    response = _get_url_with_retry(url, share=True)
+    if state is not None and not cc.memory.is_bounded():
+        state.set_result(url, response)
+    return response
 
-def get_url_json(url):
-    return _get_url_with_retry(url).json()
 
+def get_url_xml_elements(url, tags, recover=None):
+    '''Parse the xml document while it is being downloaded, and return
+    only the elements of the given tags (all else is discarded).
 
-def _get_url_with_retry(url):
-    for retry in (1, 2, 4, 8, 16, 32, 64):
+    If the document is malformed and recover is provided, the body is
+    passed to recover(body), which should return a (fixed) tree.
+    '''
+    return _get_url_with_retry(url, functools.partial(
+        _parse_xml_elements, tags=frozenset(tags), recover=recover))
+
+
+_CHUNK_SIZE = 64 * 1024
+
+# Keep at most this much of the raw body (of a document that we might
+# have to recover) in memory; the rest goes to a temporary file.
+_SPOOL_SIZE = 1024 * 1024
+
+
+def _parse_xml_elements(response, tags, recover=None):
+    parser = lxml.etree.XMLPullParser(events=('start', 'end'))
+    elements = []
+    depth = 0  # Depth within an element that we keep.
+    chunks = itertools.chain(iter_content(response), (None,))
+    with tempfile.SpooledTemporaryFile(_SPOOL_SIZE) as body:
         try:
-            return _get_url(url)
-        except:
-            time.sleep(retry)
-    return _get_url(url)
+            for chunk in chunks:
+                if chunk is None:
+                    parser.close()
+                else:
+                    if recover is not None:
+                        body.write(chunk)
+                    parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        if depth or element.tag in tags:
+                            depth += 1
+                        continue
+                    if depth:
+                        depth -= 1
+                        if depth == 0:
+                            elements.append(element)
+                            parent = element.getparent()
+                            if parent is not None:
+                                parent.remove(element)
+                        continue
+                    # Discard the element and whatever precedes it.
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+        except lxml.etree.XMLSyntaxError:
+            if recover is None:
+                raise
+            logging.warning('get_url: recover xml: url=%s', response.url,
+                            exc_info=True)
+            # Read the rest of the body rather than fetching it again.
+            for chunk in chunks:
+                if chunk is not None:
+                    body.write(chunk)
+            body.seek(0)
+            return list(recover(body.read()).iter(*tags))
+    return elements
+
+
+def _get_url_with_retry(url, consume=None, share=False):
+    '''Fetch url; raise RetryLater on retryable errors when the caller
+    is deferring, and otherwise retry (and sleep) in place.
+
+    If share is true, each try is shared with concurrent tries of url,
+    and the response is returned.
+    '''
+    if share:
+        get_url_once = functools.partial(
+            cc.statics.http_single_flight.do, url,
+            functools.partial(_get_url_once, url, None))
+    else:
+        get_url_once = functools.partial(_get_url_once, url, consume)
+    attempt = cc.retry.current_attempt()
+    if attempt is not None:
+        # Count attempts of this url rather than of the calling work,
+        # if the runner lets us.
+        state = cc.retry.current_state()
+        if state is not None:
+            attempt = state.get_attempt(url)
+        try:
+            return get_url_once()
+        except cc.retry.RetryLater as exc:
+            if attempt < cc.statics.args.retry_max:
+                if state is not None:
+                    state.set_attempt(url, attempt + 1)
+                    exc.attempt = attempt
+                raise
+            logging.error('get_url: give up after %d retries: url=%s',
+                          attempt, url)
+            raise exc.error
+    for attempt in range(cc.statics.args.retry_max + 1):
+        try:
+            return get_url_once()
+        except cc.retry.RetryLater as exc:
+            if attempt == cc.statics.args.retry_max:
+                raise exc.error
+            delay = cc.retry.get_delay(exc, attempt)
+            logging.debug('get_url: retry=%d delay=%.1f url=%s',
+                          attempt, delay, url)
+            time.sleep(delay)
+
 
+def _get_url_once(url, consume):
+    breaker = cc.statics.http_breaker
+    host = urllib.parse.urlparse(url).netloc
+    breaker.check(host)
+    try:
+        result = _get_url(url, consume or _read)
+    except Exception as exc:
+        if not cc.retry.is_retryable(exc):
+            raise
+        breaker.record_failure(host)
+        retry_after = None
+        if getattr(exc, 'response', None) is not None:
+            retry_after = cc.retry.parse_retry_after(
+                exc.response.headers.get('Retry-After'))
+        logging.debug('get_url: retryable error: url=%s', url, exc_info=True)
+        raise cc.retry.RetryLater(exc, retry_after=retry_after) from exc
+    breaker.record_success(host)
+    return result
 
-def _get_url(url):
+
+def _get_url(url, consume):
+    if not hasattr(cc.statics, 'http_cache'):
+        return _fetch_url(url, consume=consume)
+    # Since we have to store the body, we read it before consuming it.
+    cache = cc.statics.http_cache
+    cached = cache.lookup(url)
+    if cached is None:
+        response = _fetch_url(url)
+        cache.store(url, response)
+        return consume(response)
+    entry, body = cached
+    ttl = cc.statics.http_cache_ttls[_classify_url(url)]
+    if ttl is None or entry.age() < ttl:
+        logging.debug('get_url: cache hit: url=%s', url)
+        _CACHE_HITS.inc()
+        return consume(_make_cached_response(url, entry, body))
+    headers = {}
+    if entry.etag is not None:
+        headers['If-None-Match'] = entry.etag
+    if entry.last_modified is not None:
+        headers['If-Modified-Since'] = entry.last_modified
+    if not headers:
+        response = _fetch_url(url)
+        cache.store(url, response)
+        return consume(response)
+    response = _fetch_url(url, headers=headers)
+    if response.status_code == requests.codes.not_modified:
+        logging.debug('get_url: cache revalidated: url=%s', url)
+        _CACHE_HITS.inc()
+        cache.refresh(url, entry)
+        return consume(_make_cached_response(url, entry, body))
+    cache.store(url, response)
+    return consume(response)
+
+
+def _make_cached_response(url, entry, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = requests.codes.ok
+    response.encoding = entry.encoding
+    response.headers = requests.structures.CaseInsensitiveDict()
+    if entry.etag is not None:
+        response.headers['ETag'] = entry.etag
+    if entry.last_modified is not None:
+        response.headers['Last-Modified'] = entry.last_modified
+    response.raw = io.BytesIO(body)
+    return response
+
+
+def _fetch_url(url, headers=None, consume=None):
+    # Consume the body while we still hold the host slot.
+    with open_url(url, headers=headers) as response:
+        return (consume or _read)(response)
+
+
+@contextlib.contextmanager
+def open_url(url, headers=None):
+    '''Open a streaming response of url (holding a slot of its host).
+
+    Use this to transfer large bodies; the response is not cached and
+    failed requests are not retried.
+    '''
     logging.debug('get_url: url=%s', url)
-    response = requests.get(url, timeout=60)
-    if logging.is_enabled_for(logging.TRACE):
-        for header, value in response.headers.items():
-            logging.trace('get_url: %s: %s', header, value)
-    response.raise_for_status()
+    with cc.statics.http_host_limiter.hold(url):
+        host = urllib.parse.urlparse(url).netloc
+        start = time.monotonic()
+        try:
+            response = cc.statics.http_session.get(
+                url, headers=headers, timeout=60, stream=True)
+        except requests.exceptions.RequestException as exc:
+            _REQUESTS.inc(host=host, status=exc.__class__.__name__)
+            raise
+        response.raw = _ThrottledRaw(url, response.raw)
+        _REQUEST_SECONDS.observe(time.monotonic() - start, host=host)
+        _REQUESTS.inc(host=host, status=response.status_code)
+        try:
+            if logging.is_enabled_for(logging.TRACE):
+                for header, value in response.headers.items():
+                    logging.trace('get_url: %s: %s', header, value)
+            if not response.ok:
+                # Read the (error) body so that the connection is reusable.
+                response.content
+                response.raise_for_status()
+            yield response
+        finally:
+            response.close()
+
+
+def _read(response):
+    response.content
     return response
+
+
+def iter_content(response, chunk_size=_CHUNK_SIZE):
+    '''Iterate over the body of a streaming response with throttling.'''
+    # The throttling is done by _ThrottledRaw (cached responses are read
+    # from memory and are not throttled).
+    return response.iter_content(chunk_size)
+
+
+class _ThrottledRaw:
+    '''Wrap the raw (urllib3) response to throttle what is read from it.
+
+    Throttling here (rather than over Response.iter_content) lets us
+    use Response.content and the other public accessors as usual.
+    '''
+
+    def __init__(self, url, raw):
+        self._url = url
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def stream(self, *args, **kwargs):
+        return cc.bandwidth.throttle(
+            self._url, self._raw.stream(*args, **kwargs))
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        delay = cc.bandwidth.reserve(self._url, len(data))
+        if delay > 0:
+            time.sleep(delay)
+        return data
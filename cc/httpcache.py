@@ -0,0 +1,153 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Persistent on-disk cache of http responses.'''
+
+__all__ = ['Cache', 'Entry']
+
+import collections
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from cc import logging
+
+
+class Entry(collections.namedtuple(
+        'Entry', 'url etag last_modified encoding stored_at size')):
+    '''Metadata of a cached response.'''
+
+    def age(self, now=None):
+        return (now or time.time()) - self.stored_at
+
+
+class Cache:
+    '''A url-keyed on-disk cache that evicts LRU under a size cap.
+
+    Each entry is two files: KEY.body holds the response body and
+    KEY.meta holds the Entry (as JSON).  The LRU order is kept in
+    memory and restored from the files' mtime on startup.
+    '''
+
+    def __init__(self, dir_path, max_size):
+        self.dir_path = dir_path
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._lru = collections.OrderedDict()  # key -> size
+        self._size = 0
+        os.makedirs(dir_path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        keys = []
+        for file_name in os.listdir(self.dir_path):
+            key, ext = os.path.splitext(file_name)
+            if ext != '.meta':
+                continue
+            entry = self._read_entry(key)
+            if entry is None:
+                self._remove(key)
+                continue
+            mtime = os.path.getmtime(self._path(key, '.meta'))
+            keys.append((mtime, key, entry.size))
+        for _, key, size in sorted(keys):
+            self._lru[key] = size
+            self._size += size
+        logging.debug('http-cache: load %d entries (%d bytes) from %s',
+                      len(self._lru), self._size, self.dir_path)
+        self._evict()
+
+    def lookup(self, url):
+        '''Return (entry, body) or None.'''
+        key = _make_key(url)
+        with self._lock:
+            if key not in self._lru:
+                return None
+            entry = self._read_entry(key)
+            try:
+                with open(self._path(key, '.body'), 'rb') as body_file:
+                    body = body_file.read()
+            except OSError:
+                body = None
+            if entry is None or body is None or entry.url != url:
+                self._discard(key)
+                return None
+            self._lru.move_to_end(key)
+            os.utime(self._path(key, '.meta'))
+            return entry, body
+
+    def store(self, url, response):
+        '''Store a (200) response.'''
+        body = response.content
+        entry = Entry(url=url,
+                      etag=response.headers.get('ETag'),
+                      last_modified=response.headers.get('Last-Modified'),
+                      encoding=response.encoding,
+                      stored_at=time.time(),
+                      size=len(body))
+        if entry.size > self.max_size:
+            return
+        key = _make_key(url)
+        with self._lock:
+            self._discard(key)
+            self._write(key, '.body', body)
+            self._write(key, '.meta',
+                        json.dumps(entry._asdict()).encode('utf-8'))
+            self._lru[key] = entry.size
+            self._size += entry.size
+            self._evict()
+
+    def refresh(self, url, entry):
+        '''Mark an entry as revalidated (after a 304 response).'''
+        key = _make_key(url)
+        entry = entry._replace(stored_at=time.time())
+        with self._lock:
+            if key not in self._lru:
+                return
+            self._write(key, '.meta',
+                        json.dumps(entry._asdict()).encode('utf-8'))
+            self._lru.move_to_end(key)
+
+    def _evict(self):
+        while self._size > self.max_size and self._lru:
+            key = next(iter(self._lru))
+            logging.trace('http-cache: evict %s', key)
+            self._discard(key)
+
+    def _discard(self, key):
+        size = self._lru.pop(key, None)
+        if size is not None:
+            self._size -= size
+        self._remove(key)
+
+    def _remove(self, key):
+        for ext in ('.meta', '.body'):
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def _read_entry(self, key):
+        try:
+            with open(self._path(key, '.meta'), 'rb') as meta_file:
+                return Entry(**json.loads(meta_file.read().decode('utf-8')))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write(self, key, ext, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+        os.replace(tmp_path, self._path(key, ext))
+
+    def _path(self, key, ext):
+        return os.path.join(self.dir_path, key + ext)
+
+
+def _make_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
@@ -0,0 +1,248 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Download videos through http (with parallel byte ranges).'''
+
+__all__ = ['download']
+
+import concurrent.futures
+import contextvars
+import json
+import os
+import os.path
+import re
+import threading
+
+import requests
+
+import cc
+import cc.actor
+import cc.http
+import cc.inits
+import cc.metrics
+import cc.retry
+import cc.salvage
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--httpdl-connections', default=4, type=int,
+        help='set number of parallel connections per http download '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--httpdl-range-size', default=8, type=int,
+        help='set byte range size in megabytes (default: %(default)s)')
+
+
+_BYTES = cc.metrics.counter(
+    'cc_httpdl_bytes_total', 'Bytes of media transferred through http.')
+
+
+@cc.inits.init
+def init_check_args():
+    parser = cc.statics.parser
+    args = cc.statics.args
+    if args.httpdl_connections < 1:
+        parser.error('non-positive --httpdl-connections: %d' %
+                     args.httpdl_connections)
+    if args.httpdl_range_size < 1:
+        parser.error('non-positive --httpdl-range-size: %d' %
+                     args.httpdl_range_size)
+
+
+def download(url, file_name, cwd=None, part_path=None):
+    '''Download url to file_name, resuming from the salvaged part_path
+    if given.
+    '''
+    args = cc.statics.args
+    _download(url, file_name, cwd, part_path,
+              args.httpdl_connections,
+              args.httpdl_range_size * 1024 * 1024)
+
+
+def _download(url, file_name, cwd, part_path, num_connections, range_size):
+    cwd = cwd or os.getcwd()
+    output_path = os.path.join(cwd, file_name)
+    output_path_part = output_path + '.part'
+    try:
+        size = _get_size(url)
+        if size is None:
+            # We could not resume from part_path anyway; leave it be.
+            logging.debug('httpdl: no range support: %s', url)
+            _download_whole(url, output_path_part)
+        else:
+            if part_path is not None:
+                cc.salvage.take_part(part_path, output_path_part)
+            _download_ranges(url, output_path_part, size,
+                             num_connections, range_size)
+    except Exception as exc:
+        if cc.retry.is_retryable(exc) and cc.retry.can_defer():
+            # Partial results are kept; the retry resumes from them.
+            raise cc.retry.RetryLater(exc) from exc
+        raise
+    os.rename(output_path_part, output_path)
+    _Journal.remove(output_path_part)
+    logging.info('httpdl: success: %s -> %s', url, output_path)
+
+
+_PATTERN_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+
+
+def _get_size(url):
+    '''Return the size of the resource, or None if ranges are not
+    supported.
+    '''
+    with cc.http.open_url(url, headers={'Range': 'bytes=0-0'}) as response:
+        if response.status_code != requests.codes.partial_content:
+            return None
+        match = _PATTERN_CONTENT_RANGE.fullmatch(
+            response.headers.get('Content-Range', ''))
+        if not match:
+            return None
+        response.content
+        return int(match.group(3))
+
+
+def _download_whole(url, output_path_part):
+    with cc.http.open_url(url) as response, \
+            open(output_path_part, 'wb') as output:
+        size = 0
+        for chunk in cc.http.iter_content(response):
+            cc.actor.check_cancelled()
+            output.write(chunk)
+            size += len(chunk)
+            _BYTES.inc(len(chunk))
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and int(content_length) != size:
+            raise cc.Error('Content-Length mismatch (%s != %d): %s' %
+                           (content_length, size, url))
+
+
+def _download_ranges(url, output_path_part, size,
+                     num_connections, range_size):
+    all_ranges = [(start, min(start + range_size, size) - 1)
+                  for start in range(0, size, range_size)]
+    journal = _Journal(output_path_part, url, size)
+    try:
+        ranges = [r for r in all_ranges if r not in journal.done]
+        logging.debug('httpdl: %d of %d ranges to go: %s',
+                      len(ranges), len(all_ranges), url)
+        fd = os.open(output_path_part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                _preallocate(fd, size)
+            _download_ranges_parallel(url, fd, ranges, journal,
+                                      num_connections)
+        finally:
+            os.close(fd)
+    finally:
+        journal.close()
+    if not journal.done.issuperset(all_ranges):
+        raise cc.Error('Incomplete download: %s' % url)
+    actual_size = os.path.getsize(output_path_part)
+    if actual_size != size:
+        raise cc.Error('Content-Length mismatch (%d != %d): %s' %
+                       (size, actual_size, url))
+
+
+def _download_ranges_parallel(url, fd, ranges, journal, num_connections):
+    with concurrent.futures.ThreadPoolExecutor(num_connections) as executor:
+        # Copy the context (one copy for each, as a context cannot be
+        # entered by two threads at once) for the cancellation token.
+        futures = [executor.submit(contextvars.copy_context().run,
+                                   _download_range,
+                                   url, fd, start, end, journal)
+                   for start, end in ranges]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _preallocate(fd, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def _download_range(url, fd, start, end, journal):
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    with cc.http.open_url(url, headers=headers) as response:
+        match = _PATTERN_CONTENT_RANGE.fullmatch(
+            response.headers.get('Content-Range', ''))
+        if (response.status_code != requests.codes.partial_content or
+                not match or int(match.group(1)) != start):
+            raise cc.Error('Could not get range %d-%d: %s' %
+                           (start, end, url))
+        offset = start
+        for chunk in cc.http.iter_content(response):
+            # Stop, but keep completed ranges for a later resume.
+            cc.actor.check_cancelled()
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            _BYTES.inc(len(chunk))
+    if offset != end + 1:
+        raise cc.Error('Short range %d-%d (got %d bytes): %s' %
+                       (start, end, offset - start, url))
+    journal.mark_done(start, end)
+
+
+class _Journal:
+    '''Record completed byte ranges of a .part file.
+
+    The journal is an append-only file next to the .part file; its
+    first line identifies the download, and each following line is a
+    completed range.  A journal of another download is discarded.
+    '''
+
+    def __init__(self, output_path_part, url, size):
+        self.path = output_path_part + '.journal'
+        self.done = set()
+        self._lock = threading.Lock()
+        header = json.dumps({'url': url, 'size': size})
+        lines = []
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                lines = journal_file.read().splitlines()
+        if (lines and lines[0] == header and
+                os.path.exists(output_path_part)):
+            for line in lines[1:]:
+                try:
+                    start, end = map(int, line.split())
+                except ValueError:
+                    break  # Truncated line from a crash.
+                self.done.add((start, end))
+            logging.debug('httpdl: resume %d ranges: %s',
+                          len(self.done), url)
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(header + '\n')
+            self._file.flush()
+
+    def mark_done(self, start, end):
+        with self._lock:
+            self.done.add((start, end))
+            self._file.write('%d %d\n' % (start, end))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def remove(output_path_part):
+        try:
+            os.remove(output_path_part + '.journal')
+        except FileNotFoundError:
+            pass
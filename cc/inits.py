@@ -55,8 +55,11 @@ init = functools.partial(_register, levels=cc.statics.inits.levels)
 final = functools.partial(_register, levels=cc.statics.finals.levels)
 
 
-def run_inits():
+def run_inits(after=None):
+    '''Run initializers (of levels after the given one).'''
     for level in sorted(cc.statics.inits.levels):
+        if after is not None and level <= after:
+            continue
         _log(logging.DEBUG, 'inits: level=%s', getattr(level, 'name', level))
         # init_func is appended in reverse order of module dependency.
         # So add a reversed() here makes (although this does not change
@@ -0,0 +1,104 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Extract properties from the triforceManifestFeed of a html document.'''
+
+__all__ = [
+    'get_properties',
+    'get_property',
+]
+
+import json
+
+import cc
+import cc.pformat
+
+from cc import logging
+
+
+_MARKER = 'var triforceManifestFeed = '
+
+# The manifest is in a script element, and so it ends before this.
+_SCRIPT_END = '</script>'
+
+_DECODER = json.JSONDecoder()
+
+
+def get_property(doc, property_names):
+    '''Read the nested property of the manifest feed.'''
+    return get_properties(doc, property_names)[0]
+
+
+def get_properties(doc, *property_paths):
+    '''Read several nested properties of the manifest feed in one pass
+    (parsing the manifest, or a zone of it, at most once).
+    '''
+    parsed = {}  # Zone name (or None for the manifest) to blob.
+    blobs = []
+    for property_names in property_paths:
+        property_names = tuple(property_names)
+        blob, property_names = _get_zone(doc, property_names, parsed)
+        if blob is None:
+            if None not in parsed:
+                parsed[None] = _parse_manifest(doc)
+            blob = parsed[None]
+        for property_name in property_names:
+            blob = blob[property_name]
+        blobs.append(blob)
+    return blobs
+
+
+def _get_zone(doc, property_names, parsed):
+    '''Parse only the zone subtree when the path is under
+    manifest.zones; zone names are unique in the manifest, and so we
+    may locate the zone without parsing the whole manifest.
+    '''
+    if len(property_names) < 3 or property_names[:2] != ('manifest', 'zones'):
+        return None, property_names
+    zone_name = property_names[2]
+    if zone_name not in parsed:
+        parsed[zone_name] = _parse_zone(doc, zone_name)
+    zone = parsed[zone_name]
+    if zone is None:
+        return None, property_names
+    return zone, property_names[3:]
+
+
+def _parse_zone(doc, zone_name):
+    marker_start = doc.find(_MARKER)
+    if marker_start == -1:
+        return None
+    # Search the script of the manifest only (not the rest of the page),
+    # and fall back to parsing the whole manifest unless the zone name
+    # is found there exactly once.
+    end = doc.find(_SCRIPT_END, marker_start)
+    if end == -1:
+        return None
+    key = '"%s":' % zone_name
+    start = doc.find(key, marker_start, end)
+    if start == -1 or doc.find(key, start + len(key), end) != -1:
+        return None
+    start += len(key)
+    while start < end and doc[start].isspace():
+        start += 1
+    try:
+        zone, zone_end = _DECODER.raw_decode(doc, start)
+    except ValueError:
+        return None
+    if zone_end > end:
+        return None
+    return zone
+
+
+def _parse_manifest(doc):
+    start = doc.find(_MARKER)
+    if start == -1:
+        raise cc.Error('Could not find manifest feed')
+    try:
+        manifest, _ = _DECODER.raw_decode(doc, start + len(_MARKER))
+    except ValueError as exc:
+        raise cc.Error('Could not parse manifest feed: %s' % exc)
+    logging.trace('triforceManifestFeed=\n%s',
+                  cc.pformat.PrettyFormatter(manifest))
+    return manifest
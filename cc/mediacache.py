@@ -0,0 +1,132 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Persistent cache of resolved media (renditions and captions).
+
+The cache maps a video's mgid uri to what its mrss and mediagen
+documents resolve to, so that re-resolving a show we have indexed
+needs no mrss/mediagen traffic.  Entries expire after
+--media-cache-ttl seconds, and are invalidated when a download of the
+episode fails.
+'''
+
+__all__ = [
+    'MediaCache',
+    'get',
+    'invalidate',
+    'put',
+]
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import cc
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--media-cache',
+        help='cache resolved media in this (sqlite) file')
+    parser.add_argument(
+        '--media-cache-ttl', type=int, default=7*24*60*60,
+        help='set media cache time-to-live in seconds '
+             '(default: %(default)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_media_cache():
+    args = cc.statics.args
+    if args.media_cache is not None:
+        cc.statics.media_cache = MediaCache(
+            args.media_cache, args.media_cache_ttl)
+
+
+@cc.inits.final
+def final_media_cache():
+    if hasattr(cc.statics, 'media_cache'):
+        cc.statics.media_cache.close()
+
+
+def get(uri):
+    '''Return the cached media (a JSON-able blob) or None.'''
+    if not hasattr(cc.statics, 'media_cache'):
+        return None
+    return cc.statics.media_cache.get(uri)
+
+
+def put(uri, media):
+    if hasattr(cc.statics, 'media_cache'):
+        cc.statics.media_cache.put(uri, media)
+
+
+def invalidate(uri):
+    if hasattr(cc.statics, 'media_cache'):
+        cc.statics.media_cache.invalidate(uri)
+
+
+class MediaCache:
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self._lock:
+            self._connect().execute(
+                'CREATE TABLE IF NOT EXISTS media ('
+                '  uri TEXT PRIMARY KEY,'
+                '  media TEXT NOT NULL,'
+                '  resolved_at REAL NOT NULL)')
+            self._conn.commit()
+
+    def _connect(self):
+        # Do not share a connection with a forked process.
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def get(self, uri):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT media, resolved_at FROM media WHERE uri = ?',
+                (uri,)).fetchone()
+        if row is None:
+            return None
+        media, resolved_at = row
+        if time.time() - resolved_at > self.ttl:
+            logging.debug('media-cache: expired: %s', uri)
+            return None
+        logging.debug('media-cache: hit: %s', uri)
+        return json.loads(media)
+
+    def put(self, uri, media):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO media VALUES (?, ?, ?)',
+                (uri, json.dumps(media), time.time()))
+            conn.commit()
+
+    def invalidate(self, uri):
+        logging.debug('media-cache: invalidate: %s', uri)
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM media WHERE uri = ?', (uri,))
+            conn.commit()
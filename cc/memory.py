@@ -0,0 +1,114 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Memory-bounded mode and memory instrumentation.
+
+With --bounded-memory, raw documents are released once they are parsed,
+and episodes are compacted before they are dispatched.  With
+--trace-memory, memory allocation is traced (with tracemalloc) and the
+peak and per-stage usage are reported at exit.
+'''
+
+__all__ = [
+    'is_bounded',
+    'stage',
+]
+
+import collections
+import contextlib
+import threading
+import tracemalloc
+
+import cc
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--bounded-memory', action='store_true',
+        help='release documents once they are parsed, and keep only '
+             'compact episodes in flight')
+    parser.add_argument(
+        '--trace-memory', type=int, nargs='?', const=10, metavar='TOP',
+        help='trace memory allocation and report peak and per-stage usage '
+             'and top TOP allocation sites (default: %(const)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_trace_memory():
+    if cc.statics.args.trace_memory is not None:
+        tracemalloc.start()
+        cc.statics.memory_stages = _Stages()
+
+
+@cc.inits.final
+def final_trace_memory():
+    if not hasattr(cc.statics, 'memory_stages'):
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    logging.info('memory: current=%s peak=%s',
+                 _format_size(current), _format_size(peak))
+    for name, usage in cc.statics.memory_stages.get_usages():
+        logging.info('memory: stage=%s count=%d net=%s high=%s',
+                     name, usage.count,
+                     _format_size(usage.net), _format_size(usage.high))
+    snapshot = tracemalloc.take_snapshot()
+    for stat in snapshot.statistics('lineno')[:cc.statics.args.trace_memory]:
+        logging.info('memory: %s', stat)
+    tracemalloc.stop()
+
+
+def is_bounded():
+    return bool(cc.statics.args.bounded_memory)
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''Attribute memory allocated within the block to a stage.
+
+    As stages run concurrently, net usage of a stage includes what other
+    threads allocate meanwhile; take it as an upper bound.
+    '''
+    if not hasattr(cc.statics, 'memory_stages'):
+        yield
+        return
+    before, _ = tracemalloc.get_traced_memory()
+    try:
+        yield
+    finally:
+        after, _ = tracemalloc.get_traced_memory()
+        cc.statics.memory_stages.record(name, after - before, after)
+
+
+_Usage = collections.namedtuple('_Usage', 'count net high')
+
+
+class _Stages:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usages = collections.OrderedDict()
+
+    def record(self, name, net, current):
+        with self._lock:
+            usage = self._usages.get(name, _Usage(count=0, net=0, high=0))
+            self._usages[name] = _Usage(count=usage.count + 1,
+                                        net=usage.net + net,
+                                        high=max(usage.high, current))
+
+    def get_usages(self):
+        with self._lock:
+            return list(self._usages.items())
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return '%d%s' % (size, unit)
+        size /= 1024
+    return '%.1fGB' % size
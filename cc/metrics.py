@@ -0,0 +1,354 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Runtime metrics in the Prometheus text format.
+
+Modules define their metrics at import time with counter(), gauge() and
+histogram(), and update them as they go.  The metrics are served at
+http://ADDRESS:--metrics-port/metrics and/or rewritten to --metrics-file
+every --metrics-interval seconds.
+
+Only the parent process serves them; what counters and histograms
+record in a child process (see --processes) is added to those of the
+parent after each message (see take_updates() and add_updates()).
+Gauges are of the parent only.
+'''
+
+__all__ = [
+    'add_updates',
+    'counter',
+    'gauge',
+    'histogram',
+    'render',
+    'take_updates',
+]
+
+import bisect
+import collections
+import http.server
+import math
+import os
+import os.path
+import tempfile
+import threading
+
+import cc
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve metrics (in Prometheus text format) at this port')
+    parser.add_argument(
+        '--metrics-address', default='127.0.0.1',
+        help='set address to serve metrics at (default: %(default)s)')
+    parser.add_argument(
+        '--metrics-file',
+        help='periodically write metrics to this file')
+    parser.add_argument(
+        '--metrics-interval', type=float, default=10,
+        help='set interval in seconds of writing --metrics-file '
+             '(default: %(default)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_metrics():
+    # Pull in cc.actor here to avoid circular importing.
+    import cc.actor
+    if cc.actor.is_child_process():
+        # Only the parent process serves (or writes) metrics; drop what
+        # the parent recorded before forking us.
+        take_updates()
+        return
+    args = cc.statics.args
+    if args.metrics_port is not None:
+        server = http.server.ThreadingHTTPServer(
+            (args.metrics_address, args.metrics_port), _Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever,
+                         name='metrics-server', daemon=True).start()
+        logging.info('metrics: serve at %s:%d',
+                     args.metrics_address, server.server_address[1])
+        cc.statics.metrics_server = server
+    if args.metrics_file is not None:
+        if args.metrics_interval <= 0:
+            raise cc.Error('Could not set non-positive metrics interval: %s' %
+                           args.metrics_interval)
+        cc.statics.metrics_writer = _Writer(
+            args.metrics_file, args.metrics_interval)
+
+
+@cc.inits.final
+def final_metrics():
+    if hasattr(cc.statics, 'metrics_writer'):
+        cc.statics.metrics_writer.stop()
+    if hasattr(cc.statics, 'metrics_server'):
+        cc.statics.metrics_server.shutdown()
+        cc.statics.metrics_server.server_close()
+
+
+_lock = threading.Lock()
+_metrics = collections.OrderedDict()
+
+
+def counter(name, help, labels=()):
+    '''Define a monotonically increasing metric.'''
+    return _register(_Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), func=None):
+    '''Define a metric that goes up and down.
+
+    If func is given, it is called at collection time and returns the
+    value, or a dict from label value tuples to values.
+    '''
+    return _register(_Gauge(name, help, labels, func))
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300, 900, 3600)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    '''Define a distribution of observed values (such as latencies).'''
+    return _register(_Histogram(name, help, labels, buckets))
+
+
+def _register(metric):
+    with _lock:
+        if metric.name in _metrics:
+            raise cc.Error('Could not redefine metric: %s' % metric.name)
+        _metrics[metric.name] = metric
+    return metric
+
+
+def take_updates():
+    '''Return (and reset) what counters and histograms have recorded.'''
+    with _lock:
+        metrics = [metric for metric in _metrics.values()
+                   if isinstance(metric, (_Counter, _Histogram))]
+    updates = []
+    for metric in metrics:
+        values = metric.take()
+        if values:
+            updates.append((metric.name, values))
+    return updates
+
+
+def add_updates(updates):
+    '''Add updates of take_updates() (of a child process) to ours.'''
+    for name, values in updates:
+        with _lock:
+            metric = _metrics[name]
+        metric.add(values)
+
+
+def render():
+    '''Return all metrics in the Prometheus text format.'''
+    with _lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+        try:
+            samples = metric.collect()
+        except Exception:
+            logging.exception('metrics: collect %s', metric.name)
+            continue
+        for name, labels, value in samples:
+            lines.append('%s%s %s' % (name, _format_labels(labels),
+                                      _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int):
+        return '%d' % value
+    return repr(float(value))
+
+
+class _Metric:
+
+    TYPE = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise cc.Error('Metric %s has labels %s but given %s' %
+                           (self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _zip(self, key):
+        return tuple(zip(self.labels, key))
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, self._zip(key), value) for key, value in items]
+
+    def take(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+
+class _Counter(_Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def add(self, values):
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class _Gauge(_Metric):
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labels, func):
+        super().__init__(name, help, labels)
+        self._func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def collect(self):
+        if self._func is None:
+            return super().collect()
+        values = self._func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, self._zip(tuple(map(str, key))), value)
+                for key, value in sorted(values.items())]
+
+
+class _Histogram(_Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def add(self, values):
+        with self._lock:
+            for key, (counts, total) in values.items():
+                my_counts, my_total = self._values.get(
+                    key, ([0] * len(self.buckets), 0))
+                self._values[key] = (
+                    [a + b for a, b in zip(my_counts, counts)],
+                    my_total + total)
+
+    def collect(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in items:
+            labels = self._zip(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                labels + (('le', _format_value(bound)),),
+                                cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.trace('metrics: ' + format, *args)
+
+
+class _Writer:
+    '''Rewrite the metrics file periodically.'''
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='metrics-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        # Write the final numbers.
+        self.write()
+
+    def write(self):
+        dir_path = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as metrics_file:
+                metrics_file.write(render())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception('metrics: write %s', self.path)
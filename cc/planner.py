@@ -0,0 +1,133 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Plan feed windows adaptively.
+
+Starting from the --step windows (or one window of the whole range if
+--step is "auto"), the planner fetches the windows in parallel, bisects
+a window that hits the server's page limit (its result is likely
+truncated), drops empty windows, and merges consecutive sparse windows.
+The resulting feeds have their documents fetched already, except for
+windows that could not be fetched; they are planned as they are, and
+starter_helper() fetches them (with retries of its own) instead.
+'''
+
+__all__ = ['plan']
+
+import datetime
+
+import cc
+import cc.feed
+import cc.inits
+import cc.retry
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--feed-page-limit', type=int, default=100,
+        help='set max number of videos the server returns in a feed; '
+             'windows reaching it are split (default: %(default)s)')
+
+
+# Do not bisect windows shorter than this.
+_MIN_SPAN = datetime.timedelta(days=1)
+
+
+def plan(feed, start, end, step):
+    '''Plan feed windows of [start, end).'''
+    return _plan(feed, start, end, None if step == 'auto' else step,
+                 cc.statics.args.feed_page_limit)
+
+
+def _plan(feed, start, end, step, page_limit):
+    windows = feed.replace_date_range(start, end, step)
+    planned = []
+    unfetched = []
+    while windows:
+        failed = _fetch_all(windows)
+        unfetched.extend(failed)
+        next_windows = []
+        for window in windows:
+            if window in failed:
+                continue
+            if window.num_videos < page_limit:
+                planned.append(window)
+            elif window.end - window.start < _MIN_SPAN:
+                logging.warning('planner: window might be truncated: %s',
+                                window.url)
+                planned.append(window)
+            else:
+                logging.debug('planner: bisect: %s', window.url)
+                next_windows.extend(window.bisect())
+        windows = next_windows
+    planned.extend(unfetched)
+    planned.sort(key=lambda window: window.start)
+    feeds = _merge_sparse(planned, unfetched, page_limit)
+    logging.info('planner: %d windows (%d unfetched)',
+                 len(feeds), len(unfetched))
+    return feeds
+
+
+def _fetch_all(windows):
+    '''Fetch windows concurrently and return those that failed.
+
+    A failed window does not fail (or re-schedule) the whole plan.
+    '''
+    attempt = cc.retry.current_attempt()
+    retry_state = cc.retry.current_state()
+    futures = [
+        cc.statics.feed_executor.submit(_fetch, window, attempt, retry_state)
+        for window in windows]
+    failed = []
+    for window, future in zip(windows, futures):
+        try:
+            future.result()
+        except cc.retry.RetryLater as exc:
+            logging.warning('planner: leave %s to starter_helper: %s',
+                            window.url, exc.error)
+            failed.append(window)
+        except Exception:
+            logging.exception('planner: leave %s to starter_helper',
+                              window.url)
+            failed.append(window)
+    return failed
+
+
+def _fetch(window, attempt, retry_state):
+    with cc.retry.deferring(attempt, retry_state):
+        window.feed
+
+
+def _merge_sparse(windows, unfetched, page_limit):
+    '''Drop empty windows and merge consecutive windows as long as the
+    merged window has fewer videos than the page limit.
+
+    Unfetched windows are kept as they are (and are not merged across).
+    '''
+    feeds = []
+    group = []
+    group_num_videos = 0
+    for window in windows:
+        if window in unfetched:
+            if group:
+                feeds.append(cc.feed.Feed.merge(group))
+                group = []
+                group_num_videos = 0
+            feeds.append(window)
+            continue
+        if window.num_videos == 0:
+            continue
+        if group and group_num_videos + window.num_videos >= page_limit:
+            feeds.append(cc.feed.Feed.merge(group))
+            group = []
+            group_num_videos = 0
+        group.append(window)
+        group_num_videos += window.num_videos
+    if group:
+        feeds.append(cc.feed.Feed.merge(group))
+    return feeds
@@ -0,0 +1,207 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Rendition selection policies.
+
+A policy picks one of the renditions (cc.video.Rtmp objects) of a
+video, after the caps (--rendition-max-height and -max-bitrate) are
+applied.  Register more policies with the policy() decorator.
+'''
+
+__all__ = [
+    'add_pending',
+    'policy',
+    'record_transfer',
+    'select',
+]
+
+import collections
+import functools
+import threading
+import time
+
+import cc
+import cc.inits
+import cc.metrics
+
+from cc import logging
+
+
+_POLICIES = collections.OrderedDict()
+
+
+def policy(name):
+    '''Register a policy: func(rtmps, rank) -> rtmp.'''
+    def register(func):
+        _POLICIES[name] = func
+        return func
+    return register
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--rendition-policy', choices=tuple(_POLICIES), default='best',
+        help='set rendition selection policy (default: %(default)s)')
+    parser.add_argument(
+        '--rendition-max-height', type=int,
+        help='do not select renditions taller than this')
+    parser.add_argument(
+        '--rendition-max-bitrate', type=int,
+        help='do not select renditions of higher bitrate (in kbps)')
+    parser.add_argument(
+        '--rendition-ext', default='',
+        help='set preferred file extensions in order, such as .mp4,.flv')
+    parser.add_argument(
+        '--rendition-target-time', type=int, default=24*60*60,
+        help='for the adaptive policy, set the time (in seconds) within '
+             'which the queued downloads should complete '
+             '(default: %(default)s)')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_meter():
+    cc.statics.rendition_meter = _ThroughputMeter()
+
+
+_THROUGHPUT = cc.metrics.gauge(
+    'cc_media_throughput_bytes_per_second',
+    'Aggregate throughput of recent media transfers.',
+    func=lambda: cc.statics.rendition_meter.throughput or 0)
+_PENDING = cc.metrics.gauge(
+    'cc_media_pending', 'Media downloads queued or running.',
+    func=lambda: cc.statics.rendition_meter.num_pending)
+
+
+def select(rtmps):
+    '''Select one of the renditions.'''
+    args = cc.statics.args
+    exts = [ext.strip() for ext in args.rendition_ext.split(',')
+            if ext.strip()]
+    rank = functools.partial(_rank, exts=exts)
+    candidates = _apply_caps(rtmps,
+                             args.rendition_max_height,
+                             args.rendition_max_bitrate)
+    rtmp = _POLICIES[args.rendition_policy](candidates, rank)
+    logging.trace('rendition: select %s', rtmp)
+    return rtmp
+
+
+def _rank(rtmp, exts):
+    # Prefer extensions listed earlier, then larger renditions.
+    try:
+        ext_rank = -exts.index(rtmp.ext)
+    except ValueError:
+        ext_rank = -len(exts)
+    return (ext_rank, rtmp.width, rtmp.bitrate or 0)
+
+
+def _apply_caps(rtmps, max_height, max_bitrate):
+    candidates = [
+        rtmp for rtmp in rtmps
+        if ((max_height is None or rtmp.height <= max_height) and
+            (max_bitrate is None or rtmp.bitrate is None or
+             rtmp.bitrate <= max_bitrate))]
+    if not candidates:
+        # Nothing is within the caps; pick the smallest one.
+        smallest = min(rtmps, key=lambda rtmp: (rtmp.height,
+                                                rtmp.bitrate or 0))
+        candidates = [smallest]
+    return candidates
+
+
+@policy('best')
+def _best(rtmps, rank):
+    return max(rtmps, key=rank)
+
+
+@policy('adaptive')
+def _adaptive(rtmps, rank):
+    '''Pick the best rendition that, at the recently measured
+    throughput, lets the queued downloads finish within the target time.
+
+    The throughput is of all concurrent transfers together (that of the
+    link), and so each pending download gets an equal share of it.
+    '''
+    meter = cc.statics.rendition_meter
+    throughput = meter.throughput
+    if throughput is None:
+        return _best(rtmps, rank)
+    budget = (throughput * cc.statics.args.rendition_target_time /
+              max(1, meter.num_pending))
+    fitting = [rtmp for rtmp in rtmps
+               if _estimate_size(rtmp) is not None and
+               _estimate_size(rtmp) <= budget]
+    if fitting:
+        return max(fitting, key=rank)
+    sized = [rtmp for rtmp in rtmps if _estimate_size(rtmp) is not None]
+    if not sized:
+        return _best(rtmps, rank)
+    logging.debug('rendition: backlog exceeds target; pick smallest')
+    return min(sized, key=_estimate_size)
+
+
+def _estimate_size(rtmp):
+    if rtmp.bitrate is None or rtmp.duration is None:
+        return None
+    return rtmp.bitrate * 1000 / 8 * rtmp.duration
+
+
+class _ThroughputMeter:
+    '''Measure aggregate throughput of recent media transfers.'''
+
+    NUM_SAMPLES = 32
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (num_bytes, start, end) of recent transfers.
+        self._samples = collections.deque(maxlen=self.NUM_SAMPLES)
+        self.num_pending = 0
+
+    @property
+    def throughput(self):
+        '''Bytes per second of all transfers together, or None if not
+        measured yet.
+
+        Transfers run concurrently, and so the bytes are divided by the
+        time during which any of them was running (rather than by the
+        sum of their durations).
+        '''
+        with self._lock:
+            samples = sorted(self._samples, key=lambda sample: sample[1])
+        num_bytes = sum(sample[0] for sample in samples)
+        seconds = 0
+        busy_start = busy_end = None
+        for _, start, end in samples:
+            if busy_end is None or start > busy_end:
+                if busy_end is not None:
+                    seconds += busy_end - busy_start
+                busy_start, busy_end = start, end
+            else:
+                busy_end = max(busy_end, end)
+        if busy_end is not None:
+            seconds += busy_end - busy_start
+        if num_bytes <= 0 or seconds <= 0:
+            return None
+        return num_bytes / seconds
+
+    def record(self, num_bytes, seconds):
+        end = time.monotonic()
+        with self._lock:
+            self._samples.append((num_bytes, end - seconds, end))
+
+    def add_pending(self, delta):
+        with self._lock:
+            self.num_pending += delta
+
+
+def record_transfer(num_bytes, seconds):
+    '''Record a completed media transfer.'''
+    cc.statics.rendition_meter.record(num_bytes, seconds)
+
+
+def add_pending(delta):
+    '''Count media downloads that are queued or running.'''
+    cc.statics.rendition_meter.add_pending(delta)
@@ -0,0 +1,168 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Resolve feeds into episodes with asyncio.
+
+The resolver walks the Feed -> VideoBlob -> Video -> Episode chain of
+many feeds at once, as a coroutine actor on the event loop of the
+asyncio runtime (and so it needs --runtime asyncio).  cc.http is
+blocking, and so each fetch runs in the io executor of the runtime
+(see cc.actor.aio.run_io()), with the shared session; the event loop
+bounds and schedules them, and no worker thread is held while waiting.
+'''
+
+__all__ = [
+    'Resolver',
+    'resolve',
+]
+
+import asyncio
+import collections
+import itertools
+
+import cc
+import cc.actor
+import cc.actor.aio
+import cc.catalog
+import cc.episode
+import cc.feed
+import cc.http
+import cc.inits
+import cc.retry
+import cc.sync
+import cc.video
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--resolver', choices=('actor', 'asyncio'), default='actor',
+        help='set metadata resolver; asyncio needs --runtime asyncio '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--resolver-concurrency', type=int, default=32,
+        help='set max in-flight requests of asyncio resolver '
+             '(default: %(default)s)')
+
+
+@cc.inits.init
+def init_check_args():
+    parser = cc.statics.parser
+    args = cc.statics.args
+    if args.resolver_concurrency < 1:
+        parser.error('non-positive --resolver-concurrency: %d' %
+                     args.resolver_concurrency)
+    if args.resolver == 'asyncio' and args.runtime != 'asyncio':
+        parser.error('--resolver asyncio needs --runtime asyncio')
+
+
+@cc.actor.actor(pool='meta')
+async def resolve(feeds, on_episode):
+    '''Resolve feeds and call on_episode(episode) for each episode.
+
+    Episodes are reported as soon as all of their videos are resolved.
+    '''
+    resolver = Resolver(cc.statics.args.resolver_concurrency)
+    await resolver.resolve(feeds, on_episode)
+
+
+class Resolver:
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    async def resolve(self, feeds, on_episode):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._resolve_feed(feed, on_episode)
+                               for feed in feeds))
+
+    async def _call(self, func, *args):
+        for attempt in itertools.count():
+            try:
+                async with self._semaphore:
+                    return await cc.actor.aio.run_io(
+                        _run_deferring, attempt, func, args)
+            except cc.retry.RetryLater as exc:
+                delay = cc.retry.get_delay(exc, attempt)
+                logging.debug('resolver: retry=%d delay=%.1f: %s',
+                              attempt, delay, exc.error)
+            # Sleep without holding the semaphore.
+            await asyncio.sleep(delay)
+
+    async def _resolve_feed(self, feed, on_episode):
+        try:
+            # Feed.videos fetches (and memorizes) the feed document.
+            feed_videos = await self._call(lambda: feed.videos)
+            logging.info('resolver: feed.url=%s videos=%d',
+                         feed.url, len(feed_videos))
+            # Parse each page as soon as it is fetched so that we do not
+            # hold all the page documents at once.
+            results = await asyncio.gather(
+                *(self._call(_get_video_blob, feed_video)
+                  for feed_video in feed_videos),
+                return_exceptions=True)
+        except Exception:
+            logging.exception('resolver: feed.url=%s', feed.url)
+            return
+        # We do not know the episode of a page that could not be
+        # resolved, and so no episode of its date is complete.
+        video_blobs = []
+        failed_dates = set()
+        for feed_video, result in zip(feed_videos, results):
+            if isinstance(result, Exception):
+                logging.error('resolver: page_url=%s', feed_video.page_url,
+                              exc_info=result)
+                failed_dates.add(feed_video.date)
+            else:
+                video_blobs.append(result)
+        groups = collections.OrderedDict()
+        for video_blob, fne in cc.video.make_fnes(video_blobs):
+            key = (video_blob.date, video_blob.episode_url)
+            groups.setdefault(key, []).append((video_blob, fne))
+        for date, episode_url in list(groups):
+            dir_name = cc.episode.make_dir_name(episode_url, date)
+            if date in failed_dates:
+                logging.error('resolver: incomplete: %s', dir_name)
+                del groups[date, episode_url]
+            elif cc.catalog.is_complete(dir_name):
+                logging.info('resolver: skip: complete: %s', dir_name)
+                del groups[date, episode_url]
+        oks = await asyncio.gather(
+            *(self._resolve_episode(feed, date, episode_url, group, on_episode)
+              for (date, episode_url), group in groups.items()))
+        failed_dates.update(date for (date, _), ok in zip(groups, oks)
+                            if not ok)
+        if cc.sync.get_state() is not None:
+            cc.sync.record_window(feed.start, failed_dates)
+
+    async def _resolve_episode(self, feed, date, episode_url, group,
+                               on_episode):
+        try:
+            videos = await asyncio.gather(
+                *(self._resolve_video(feed, video_blob, fne)
+                  for video_blob, fne in group))
+        except Exception:
+            logging.exception('resolver: episode_url=%s', episode_url)
+            return False
+        on_episode(cc.episode.Episode.from_videos(date, episode_url, videos))
+        return True
+
+    async def _resolve_video(self, feed, video_blob, fne):
+        rtmps, captions = await self._call(
+            cc.video.resolve_media, feed.show_url, video_blob.uri)
+        return cc.video.Video.from_media(video_blob, fne, rtmps, captions)
+
+
+def _get_video_blob(feed_video):
+    page_doc = cc.http.get_url(feed_video.page_url)
+    return cc.feed.make_video_blob(feed_video, page_doc)
+
+
+def _run_deferring(attempt, func, args):
+    with cc.retry.deferring(attempt):
+        return func(*args)
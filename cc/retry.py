@@ -0,0 +1,253 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Retry policy: back-off with jitter, Retry-After, and circuit breaker.
+
+Code that fails with a retryable error raises RetryLater instead of
+sleeping.  Whoever runs the code (such as the actor threads) catches it
+and re-schedules the work after get_delay() seconds.  To tell the code
+that it is being run this way, the runner wraps it in deferring().
+
+The runner may also pass a RetryState, which is kept across the
+re-runs of the work, so that code counts attempts of each fetch (rather
+than of the whole work) and does not redo fetches that succeeded.
+'''
+
+__all__ = [
+    'CircuitBreaker',
+    'RetryLater',
+    'RetryState',
+    'can_defer',
+    'current_attempt',
+    'current_state',
+    'deferring',
+    'get_delay',
+    'is_retryable',
+    'parse_retry_after',
+]
+
+import collections
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+import cc
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--retry-max', type=int, default=7,
+        help='set max number of retries (default: %(default)s)')
+    parser.add_argument(
+        '--retry-base', type=float, default=1,
+        help='set base retry delay in seconds (default: %(default)s)')
+    parser.add_argument(
+        '--retry-cap', type=float, default=64,
+        help='set max retry delay in seconds (default: %(default)s)')
+    parser.add_argument(
+        '--breaker-threshold', type=int, default=5,
+        help='open circuit of a host after this many consecutive errors '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--breaker-cooldown', type=float, default=30,
+        help='set seconds before retrying a host with open circuit '
+             '(default: %(default)s)')
+
+
+class RetryLater(cc.Error):
+    '''Ask the runner to re-schedule the work.'''
+
+    def __init__(self, error, retry_after=None, attempt=None):
+        super().__init__('retry later: %r' % error)
+        self.error = error
+        self.retry_after = retry_after
+        # The attempt of the failed fetch, if counted on its own.
+        self.attempt = attempt
+
+    def __reduce__(self):
+        return (RetryLater, (self.error, self.retry_after, self.attempt))
+
+
+class RetryState:
+    '''Attempts of, and results of, keys (such as urls) of a work.
+
+    Results are not carried to (or from) a child process, as they might
+    not be picklable; the attempts are.  Only the results of the last
+    MAX_RESULTS keys are kept, so that a long work (such as one walking
+    many feed pages) does not hold every response it has fetched.
+    '''
+
+    MAX_RESULTS = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self._results = collections.OrderedDict()
+
+    def __getstate__(self):
+        with self._lock:
+            return self._attempts.copy()
+
+    def __setstate__(self, attempts):
+        self._lock = threading.Lock()
+        self._attempts = attempts
+        self._results = collections.OrderedDict()
+
+    def get_attempt(self, key):
+        with self._lock:
+            return self._attempts.get(key, 0)
+
+    def set_attempt(self, key, attempt):
+        with self._lock:
+            self._attempts[key] = attempt
+
+    def get_result(self, key):
+        '''Return the result of the key, or None if it is not done.'''
+        with self._lock:
+            return self._results.get(key)
+
+    def set_result(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.MAX_RESULTS:
+                self._results.popitem(last=False)
+
+
+# Context variables (rather than thread-locals) so that they work for
+# asyncio tasks sharing a thread, too.
+_attempt = contextvars.ContextVar('attempt', default=None)
+_state = contextvars.ContextVar('state', default=None)
+
+
+@contextlib.contextmanager
+def deferring(attempt, state=None):
+    '''Run code that may raise RetryLater at its attempt-th retry.'''
+    token = _attempt.set(attempt)
+    state_token = _state.set(state)
+    try:
+        yield
+    finally:
+        _state.reset(state_token)
+        _attempt.reset(token)
+
+
+def current_attempt():
+    '''Return the attempt number or None if not inside deferring().'''
+    return _attempt.get()
+
+
+def current_state():
+    '''Return the RetryState or None if the runner does not keep one.'''
+    return _state.get()
+
+
+def can_defer():
+    '''True if the caller is deferring and has retries left.'''
+    attempt = current_attempt()
+    return attempt is not None and attempt < cc.statics.args.retry_max
+
+
+def get_delay(retry_later, attempt):
+    args = cc.statics.args
+    return _get_delay(retry_later, attempt, args.retry_base, args.retry_cap)
+
+
+def _get_delay(retry_later, attempt, base, cap):
+    if retry_later.attempt is not None:
+        attempt = retry_later.attempt
+    # "Equal jitter": half of the back-off is fixed and half is random,
+    # so that workers throttled at the same time do not come back at
+    # the same time.
+    backoff = min(cap, base * 2 ** attempt)
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    if retry_later.retry_after is not None:
+        delay = max(delay, retry_later.retry_after)
+    return delay
+
+
+def is_retryable(error):
+    if isinstance(error, (requests.exceptions.ChunkedEncodingError,
+                          requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        status_code = error.response.status_code
+        return (status_code in (requests.codes.request_timeout,
+                                requests.codes.too_many_requests) or
+                status_code >= 500)
+    return False
+
+
+def parse_retry_after(value):
+    '''Parse Retry-After header (seconds or http date) into seconds.'''
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logging.debug('retry: could not parse Retry-After: %s', value)
+        return None
+    now = datetime.datetime.now(date.tzinfo)
+    return max(0, (date - now).total_seconds())
+
+
+class CircuitBreaker:
+    '''Per-host circuit breaker.
+
+    After `threshold` consecutive failures the circuit of a host is
+    opened, and requests to it fail fast for `cooldown` seconds.  Then
+    one request is let through; the circuit is closed if it succeeds
+    and opened again otherwise.
+    '''
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_until = {}
+
+    def check(self, host):
+        '''Raise RetryLater if the circuit of the host is open.'''
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return
+            now = time.time()
+            if now < open_until:
+                raise RetryLater(cc.Error('circuit is open: %s' % host),
+                                 retry_after=open_until - now)
+            # Half open: let this request through, and block others
+            # until it completes.
+            self._open_until[host] = now + self.cooldown
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            if self._open_until.pop(host, None) is not None:
+                logging.info('retry: close circuit: %s', host)
+
+    def record_failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold:
+                if host not in self._open_until:
+                    logging.warning('retry: open circuit: %s', host)
+                self._open_until[host] = time.time() + self.cooldown
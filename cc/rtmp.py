@@ -4,19 +4,24 @@
 
 '''Download videos through rtmp.'''
 
-__all__ = ['download']
+__all__ = [
+    'async_download',
+    'download',
+]
 
+import asyncio
 import hashlib
-import itertools
 import os
 import os.path
 import psutil
 import shutil
-import threading
 import time
 
 import cc
+import cc.actor
+import cc.bandwidth
 import cc.inits
+import cc.metrics
 
 from cc import logging
 
@@ -24,6 +29,11 @@ from cc import logging
 RTMPDUMP_INCOMPLETE = 2
 
 
+_BYTES = cc.metrics.counter(
+    'cc_rtmp_bytes_total', 'Bytes transferred through rtmp (as sampled '
+    'every --rtmp-monitor-period).')
+
+
 @cc.inits.init(cc.inits.Level.EARLIER)
 def init_argparser():
     parser = cc.statics.parser
@@ -73,16 +83,10 @@ def _download(url, file_name, cwd,
               cpu_bound,
               memory_bound,
               partial_okay):
-    cwd = cwd or os.getcwd()
-    file_name_part = file_name + '.part'
-    output_path = os.path.join(cwd, file_name)
-    output_path_part = os.path.join(cwd, file_name_part)
-    digest = None
-    for retry_exp in itertools.count():
-        timer = threading.Timer(download_timeout, lambda: None)
-        timer.daemon = True
-        proc = _make_subprocess(url, file_name_part, cwd, prog)
-        timer.start()
+    dl = _Download(url, file_name, cwd, prog, download_timeout,
+                   cpu_bound, memory_bound, partial_okay)
+    while True:
+        proc = _make_subprocess(dl.start(), dl.cwd)
         ret = -1
         while True:
             try:
@@ -90,65 +94,240 @@ def _download(url, file_name, cwd,
                 break
             except psutil.TimeoutExpired:
                 pass
-            cpu_percent = proc.get_cpu_percent(interval=None)
-            memory_percent = proc.get_memory_percent()
-            logging.trace('rtmp: pid=%d cpu=%.1f memory=%.1f',
-                          proc.pid, cpu_percent, memory_percent)
-            if cpu_percent > cpu_bound:
-                logging.error('rtmp: cpu limit exceeded')
+            action = dl.check(proc)
+            if action is _CANCEL:
+                # Stop, but keep the .part file for a later resume.
+                proc.terminate()
+                proc.wait()
+                raise dl.cancelled()
+            if action is _KILL:
                 proc.kill()
+                ret = proc.wait()
                 break
-            if memory_percent > memory_bound:
-                logging.error('rtmp: memory limit exceeded')
-                proc.kill()
+            if action > 0:
+                proc.suspend()
+                time.sleep(action)
+                proc.resume()
+        digest = None
+        if dl.needs_digest(ret):
+            digest = _get_digest(dl.output_path_part)
+        delay = dl.finish(ret, digest)
+        if delay is None:
+            return
+        time.sleep(delay)
+
+
+async def async_download(url, file_name, cwd=None):
+    '''Download like download() but supervise the subprocess on the
+    event loop rather than blocking a thread.
+    '''
+    args = cc.statics.args
+    await _async_download(url, file_name, cwd,
+                          args.rtmp_program,
+                          args.rtmp_timeout,
+                          args.rtmp_monitor_period,
+                          args.rtmp_cpu_bound,
+                          args.rtmp_memory_bound,
+                          args.rtmp_partial_okay)
+
+
+async def _async_download(url, file_name, cwd,
+                          prog,
+                          download_timeout,
+                          monitor_period,
+                          cpu_bound,
+                          memory_bound,
+                          partial_okay):
+    loop = asyncio.get_running_loop()
+    dl = _Download(url, file_name, cwd, prog, download_timeout,
+                   cpu_bound, memory_bound, partial_okay)
+    while True:
+        cmd = dl.start()
+        logging.debug('exec: CWD=%s %s', dl.cwd, ' '.join(cmd))
+        aproc = await asyncio.create_subprocess_exec(*cmd, cwd=dl.cwd)
+        proc = None
+        ret = -1
+        while True:
+            try:
+                ret = await asyncio.wait_for(aproc.wait(), monitor_period)
                 break
-            if timer.finished.is_set():
-                logging.error('rtmp: timeout: %s -> %s', url, output_path_part)
-                proc.kill()
+            except asyncio.TimeoutError:
+                pass
+            # The process may have exited (and been reaped) already; the
+            # next wait returns at once then.
+            try:
+                proc = proc or psutil.Process(aproc.pid)
+            except psutil.NoSuchProcess:
+                continue
+            action = dl.check(proc)
+            if action is _CANCEL:
+                aproc.terminate()
+                await aproc.wait()
+                raise dl.cancelled()
+            if action is _KILL:
+                aproc.kill()
+                ret = await aproc.wait()
                 break
-        timer.cancel()
-        if prog == 'rtmpdump' and ret == RTMPDUMP_INCOMPLETE:
-            if partial_okay:
-                logging.warning(
-                    'rtmp: partial download %s to %s', url, file_name)
+            if action > 0:
+                proc.suspend()
+                await asyncio.sleep(action)
+                proc.resume()
+        digest = None
+        if dl.needs_digest(ret):
+            digest = await loop.run_in_executor(
+                None, _get_digest, dl.output_path_part)
+        delay = dl.finish(ret, digest)
+        if delay is None:
+            return
+        await asyncio.sleep(delay)
+
+
+# What check() tells the supervisor to do with the subprocess (other
+# than pausing it for a while).
+_CANCEL = object()
+_KILL = object()
+
+
+class _Download:
+    '''Decide what to do with the subprocess of a download, for both
+    download() and async_download(); they differ only in how they wait
+    (on a thread or on the event loop).
+    '''
+
+    def __init__(self, url, file_name, cwd, prog, download_timeout,
+                 cpu_bound, memory_bound, partial_okay):
+        self.url = url
+        self.file_name = file_name
+        self.cwd = cwd or os.getcwd()
+        self.prog = prog
+        self.download_timeout = download_timeout
+        self.cpu_bound = cpu_bound
+        self.memory_bound = memory_bound
+        self.partial_okay = partial_okay
+        self.file_name_part = file_name + '.part'
+        self.output_path = os.path.join(self.cwd, file_name)
+        self.output_path_part = os.path.join(self.cwd, self.file_name_part)
+        self._digest = None
+        self._retry_exp = 0
+        self._deadline = None
+        self._part_size = 0
+
+    def start(self):
+        '''Start an attempt and return the command to run.'''
+        cc.actor.check_cancelled()
+        self._deadline = time.monotonic() + self.download_timeout
+        self._part_size = _get_size(self.output_path_part)
+        return _make_command(self.url, self.file_name_part, self.prog)
+
+    def check(self, proc):
+        '''Check the subprocess (every monitor period), and return
+        _CANCEL, _KILL, or how long to pause it for.
+        '''
+        if cc.actor.is_cancelled():
+            logging.info('rtmp: cancelled: %s -> %s',
+                         self.url, self.output_path_part)
+            return _CANCEL
+        # Charge the bandwidth shaper for what was transferred, and pause
+        # the subprocess if we are over the limit.
+        new_part_size = _get_size(self.output_path_part)
+        _BYTES.inc(max(0, new_part_size - self._part_size))
+        delay = cc.bandwidth.reserve(self.url,
+                                     new_part_size - self._part_size)
+        self._part_size = new_part_size
+        if _is_over_bounds(proc, self.cpu_bound, self.memory_bound):
+            return _KILL
+        if time.monotonic() > self._deadline:
+            logging.error('rtmp: timeout: %s -> %s',
+                          self.url, self.output_path_part)
+            return _KILL
+        if delay > 0:
+            logging.trace('rtmp: pid=%d throttle=%.1f', proc.pid, delay)
+        return delay
+
+    def cancelled(self):
+        return cc.actor.Cancelled('Cancelled download: %s' % self.url)
+
+    def needs_digest(self, ret):
+        '''True if finish() needs the digest of the .part file.'''
+        return (self.prog == 'rtmpdump' and ret == RTMPDUMP_INCOMPLETE and
+                not self.partial_okay)
+
+    def finish(self, ret, digest):
+        '''Finish an attempt, and return the delay before resuming the
+        download, or None if it is done.
+        '''
+        if self.prog == 'rtmpdump' and ret == RTMPDUMP_INCOMPLETE:
+            if self.partial_okay:
+                logging.warning('rtmp: partial download %s to %s',
+                                self.url, self.file_name)
                 ret = 0
-                break
-            with open(output_path_part, 'rb') as output_file:
-                new_digest = hashlib.sha1(output_file.read()).digest()
-            if digest is not None and digest == new_digest:
+            elif self._digest is not None and self._digest == digest:
                 # We made no progress; the download might be completed.
                 # Let's not retry and assume it was.
-                logging.warning(
-                    'rtmp: no progress: url=%s file_name=%s', url, file_name)
+                logging.warning('rtmp: no progress: url=%s file_name=%s',
+                                self.url, self.file_name)
                 ret = 0
-                break
-            digest = new_digest
-            # rtmpdump didn't complete the transfer; resume might get further.
-            retry = 2 ** retry_exp
-            if retry > download_timeout:
-                logging.error('rtmp: retry timeout: %s -> %s',
-                              url, output_path_part)
             else:
-                logging.trace('rtmp: retry=%d url=%s', retry, url)
-                time.sleep(retry)
-                continue
+                self._digest = digest
+                # rtmpdump didn't complete the transfer; resume might get
+                # further.
+                retry = 2 ** self._retry_exp
+                self._retry_exp += 1
+                if retry <= self.download_timeout:
+                    logging.trace('rtmp: retry=%d url=%s', retry, self.url)
+                    return retry
+                logging.error('rtmp: retry timeout: %s -> %s',
+                              self.url, self.output_path_part)
         if ret is not None and ret != 0:
-            raise cc.Error('Could not download (ret=%s): %s' % (ret, url))
-        # Okay, we are done.
-        break
-    os.rename(output_path_part, output_path)
-    logging.info('rtmp: success: %s -> %s', url, output_path)
+            raise cc.Error('Could not download (ret=%s): %s' %
+                           (ret, self.url))
+        os.rename(self.output_path_part, self.output_path)
+        logging.info('rtmp: success: %s -> %s', self.url, self.output_path)
+        return None
 
 
-def _make_subprocess(url, file_name, cwd, prog):
-    if prog == 'rtmpdump':
-        cmd = ['rtmpdump',
-               '--quiet',
-               '--rtmp', url,
-               '--flv', file_name,
-               '--resume',
-               '--skip', '1']
-    else:
-        cmd = ['ffmpeg', '-i', url, file_name]
+def _is_over_bounds(proc, cpu_bound, memory_bound):
+    cpu_percent = proc.get_cpu_percent(interval=None)
+    memory_percent = proc.get_memory_percent()
+    logging.trace('rtmp: pid=%d cpu=%.1f memory=%.1f',
+                  proc.pid, cpu_percent, memory_percent)
+    if cpu_percent > cpu_bound:
+        logging.error('rtmp: cpu limit exceeded')
+        return True
+    if memory_percent > memory_bound:
+        logging.error('rtmp: memory limit exceeded')
+        return True
+    return False
+
+
+def _get_digest(path, chunk_size=1024*1024):
+    # Read in chunks so that we do not hold the whole file in memory.
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+
+def _get_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _make_subprocess(cmd, cwd):
     logging.debug('exec: CWD=%s %s', cwd, ' '.join(cmd))
     return psutil.Popen(cmd, cwd=cwd)
+
+
+def _make_command(url, file_name, prog):
+    if prog == 'rtmpdump':
+        return ['rtmpdump',
+                '--quiet',
+                '--rtmp', url,
+                '--flv', file_name,
+                '--resume',
+                '--skip', '1']
+    else:
+        return ['ffmpeg', '-i', url, file_name]
@@ -4,32 +4,133 @@
 
 '''Salvage results from failed/partial downloads.'''
 
-__all__ = ['Salvage']
+__all__ = [
+    'Salvage',
+    'take_part',
+]
 
+import errno
 import os
 import os.path
+import shutil
+
+from cc import logging
 
 
 class Salvage:
 
-    def __init__(self, dir_name, salvage_dirs):
+    def __init__(self, dir_name, salvage_dirs, part_dirs=()):
         self.salvage = {}
+        self.parts = {}
+        # Temporary directories of earlier tries of the episode.
+        self.tmp_dir_paths = []
         for salvage_dir in salvage_dirs:
-            _update_salvage_map(self.salvage, dir_name, salvage_dir)
+            _update_salvage_map(self.salvage, self.parts, dir_name,
+                                salvage_dir)
+        # Only partial files are salvaged from part_dirs, and only from
+        # the temporary directories of the episode (see
+        # cc.actor.downloader).
+        for part_dir in part_dirs:
+            self.tmp_dir_paths.extend(_update_salvage_map(
+                {}, self.parts, dir_name, part_dir, tmp_only=True))
 
     def find(self, dir_name, file_name):
         return self.salvage.get(os.path.join(dir_name, file_name))
 
+    def find_part(self, dir_name, file_name):
+        '''Return the path of a partial file (FILE_NAME.part) to resume
+        the download of the file from.
+        '''
+        return self.parts.get(os.path.join(dir_name, file_name))
+
+    def remove_tmp_dirs(self):
+        '''Remove temporary directories of earlier tries of the episode
+        (they are superseded once the episode is complete).
+        '''
+        for tmp_dir_path in self.tmp_dir_paths:
+            logging.debug('salvage: remove %s', tmp_dir_path)
+            shutil.rmtree(tmp_dir_path, ignore_errors=True)
+
 
-def _update_salvage_map(salvage_map, dir_name, salvage_dir):
+def take_part(part_path, output_path_part):
+    '''Move a salvaged .part file (and its journal, see cc.httpdl) to
+    output_path_part so that the download resumes from it.
+
+    Nothing is done if output_path_part exists (say, in a retry, which
+    resumes from its own).
+    '''
+    if os.path.exists(output_path_part):
+        return
+    logging.info('salvage: resume: %s -> %s', part_path, output_path_part)
+    for suffix in ('', '.journal'):
+        if not os.path.exists(part_path + suffix):
+            continue
+        try:
+            os.replace(part_path + suffix, output_path_part + suffix)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            # On another file system.
+            shutil.copy2(part_path + suffix, output_path_part + suffix)
+
+
+def _update_salvage_map(salvage_map, part_map, dir_name, salvage_dir,
+                        tmp_only=False):
+    tmp_dir_paths = []
     for tmp_dir_name in os.listdir(salvage_dir):
-        # Search '*DIR_NAME*/*' but ignore '*.part' file.
-        if dir_name not in tmp_dir_name:
+        # Search '*DIR_NAME*/*' but put '*.part' file aside.
+        if tmp_only:
+            if not (tmp_dir_name.startswith('tmp') and
+                    tmp_dir_name.endswith('-' + dir_name)):
+                continue
+        elif dir_name not in tmp_dir_name:
             continue
         tmp_dir_path = os.path.join(salvage_dir, tmp_dir_name)
+        if not os.path.isdir(tmp_dir_path):
+            continue
+        tmp_dir_paths.append(tmp_dir_path)
         for file_name in os.listdir(tmp_dir_path):
+            salvage_path = os.path.join(tmp_dir_path, file_name)
+            if file_name.endswith('.journal'):
+                # Taken along with its .part file.
+                continue
             if file_name.endswith('.part'):
+                key = os.path.join(dir_name, file_name[:-len('.part')])
+                # Resume from the one that got the furthest.
+                if (key not in part_map or
+                        _get_progress(part_map[key]) <
+                        _get_progress(salvage_path)):
+                    part_map[key] = salvage_path
                 continue
             key = os.path.join(dir_name, file_name)
-            salvage_path = os.path.join(tmp_dir_path, file_name)
             salvage_map[key] = salvage_path
+    return tmp_dir_paths
+
+
+def _get_progress(part_path):
+    '''Return the number of bytes of a .part file that are downloaded.
+
+    cc.httpdl preallocates the .part file and records completed byte
+    ranges in a journal (a header line and then one "START END" line for
+    each range); other .part files are written in order.
+    '''
+    try:
+        with open(part_path + '.journal') as journal_file:
+            lines = journal_file.read().splitlines()
+    except FileNotFoundError:
+        return _get_size(part_path)
+    progress = 0
+    for line in lines[1:]:
+        try:
+            start, end = map(int, line.split())
+        except ValueError:
+            break  # Truncated line from a crash.
+        progress += end - start + 1
+    return progress
+
+
+def _get_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
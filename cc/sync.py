@@ -0,0 +1,157 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Incremental (delta) sync of a show.
+
+For each show url we persist a watermark (the newest airDate up to
+which everything is processed) and the ids of videos already seen.
+Later runs start feeds from the watermark and skip the seen videos
+before fetching their pages.
+
+The watermark does not advance past a failed episode, nor past a feed
+window whose episodes are not all resolved (see record_window()).
+'''
+
+__all__ = [
+    'SyncState',
+    'get_state',
+    'record_window',
+]
+
+import collections
+import datetime
+import json
+import os
+import os.path
+import tempfile
+import threading
+
+import cc
+import cc.actor
+import cc.inits
+
+from cc import logging
+
+
+@cc.inits.init(cc.inits.Level.EARLIER)
+def init_argparser():
+    parser = cc.statics.parser
+    parser.add_argument(
+        '--sync-state',
+        help='sync incrementally and keep the sync state in this file')
+
+
+@cc.inits.init(cc.inits.Level.LATE)
+def init_sync_state():
+    args = cc.statics.args
+    if args.sync_state is not None:
+        cc.statics.sync_state = SyncState(args.sync_state, args.show_url)
+
+
+@cc.inits.final
+def final_sync_state():
+    if hasattr(cc.statics, 'sync_state'):
+        cc.statics.sync_state.save()
+
+
+def get_state():
+    '''Return the SyncState, or None if not syncing incrementally.'''
+    return getattr(cc.statics, 'sync_state', None)
+
+
+@cc.actor.actor(priority=cc.actor.Priority.CONTROL, pool='meta')
+def record_window(start, failed_dates=()):
+    '''Record that the episodes of the window from start are resolved
+    (and dispatched), but for those of failed_dates.
+
+    This is a message so that it reaches the sync state of the parent
+    process from starter_helper() in a child process.
+    '''
+    sync_state = get_state()
+    if sync_state is not None:
+        sync_state.record_window(start, failed_dates)
+
+
+class SyncState:
+
+    def __init__(self, path, show_url):
+        self.path = path
+        self.show_url = show_url
+        self._lock = threading.Lock()
+        self._states = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self._states = json.load(state_file)
+        state = self._states.get(show_url, {})
+        watermark = state.get('watermark')
+        self.watermark = (None if watermark is None else
+                          datetime.datetime.fromtimestamp(watermark))
+        self.seen_ids = frozenset(state.get('seen_ids', ()))
+        self._new_ids = set()
+        self._succeeded_dates = set()
+        self._failed_dates = set()
+        # Start dates of feed windows not resolved yet.
+        self._pending_windows = collections.Counter()
+        logging.info('sync: watermark=%s seen_ids=%d',
+                     self.watermark, len(self.seen_ids))
+
+    def record_success(self, episode):
+        with self._lock:
+            self._succeeded_dates.add(episode.date)
+            self._new_ids.update(
+                _get_id(video.uri) for video in episode.videos
+                if video.uri is not None)
+
+    def record_failure(self, episode):
+        with self._lock:
+            self._failed_dates.add(episode.date)
+
+    def add_windows(self, starts):
+        '''Add feed windows to be resolved.'''
+        with self._lock:
+            self._pending_windows.update(starts)
+
+    def record_window(self, start, failed_dates):
+        with self._lock:
+            self._pending_windows[start] -= 1
+            if self._pending_windows[start] <= 0:
+                del self._pending_windows[start]
+            self._failed_dates.update(failed_dates)
+
+    def save(self):
+        with self._lock:
+            watermark = self._get_new_watermark()
+            seen_ids = sorted(self.seen_ids | self._new_ids)
+        logging.info('sync: save watermark=%s seen_ids=%d',
+                     watermark, len(seen_ids))
+        self._states[self.show_url] = {
+            'watermark': None if watermark is None else watermark.timestamp(),
+            'seen_ids': seen_ids,
+        }
+        dir_path = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as state_file:
+            json.dump(self._states, state_file)
+        os.replace(tmp_path, self.path)
+
+    def _get_new_watermark(self):
+        # Do not advance past the earliest failure (or the earliest
+        # window that is not resolved, say, because starter_helper()
+        # gave up on it), so that the next run fetches it again.
+        if self._failed_dates:
+            candidate = min(self._failed_dates)
+        elif self._succeeded_dates:
+            candidate = max(self._succeeded_dates)
+        else:
+            return self.watermark
+        if self._pending_windows:
+            candidate = min(candidate, min(self._pending_windows))
+        if self.watermark is None:
+            return candidate
+        return max(self.watermark, candidate)
+
+
+def _get_id(uri):
+    # uri format: mgid:arc:video:HOST_NAME:UUID
+    return uri[uri.rfind(':')+1:]
@@ -4,22 +4,30 @@
 
 '''Representation of a video.'''
 
-__all__ = ['Video']
+__all__ = [
+    'Video',
+    'get_media',
+    'get_mediagen_url',
+    'make_fnes',
+    'make_mrss_url',
+    'resolve_media',
+]
 
 import collections
 import os.path
 import re
 import urllib.parse
 
-import lxml.etree
-
 import cc.http
-
-from cc import logging
+import cc.mediacache
+import cc.memory
+import cc.rendition
+import cc.xmlfix
 
 
 class Video(collections.namedtuple(
-        'Video', 'page_url episode_url fne date rtmps captions')):
+        'Video', 'page_url episode_url fne date rtmps captions uri',
+        defaults=(None,))):
     '''One video.
 
     Note: 'fne' stands for file name no extension.
@@ -27,47 +35,77 @@ class Video(collections.namedtuple(
 
     @staticmethod
     def make_videos(feed):
-        videos = []
-        part_indexes = collections.defaultdict(int)
-        for video_blob in feed.video_blobs:
-            fne = _make_fne(video_blob.page_url)
-            if (video_blob.episode_url is not None and
-                    not _look_like_recap_video(video_blob.page_url)):
-                index = part_indexes[video_blob.episode_url] + 1
-                part_indexes[video_blob.episode_url] = index
-                fne = 'part-%d-%s' % (index, fne)
-            mediagen_tree = _get_mediagen_tree(feed, video_blob)
-            videos.append(Video(
-                page_url=video_blob.page_url,
-                episode_url=video_blob.episode_url,
-                fne=fne,
-                date=video_blob.date,
-                rtmps=_get_rtmps(mediagen_tree),
-                captions=_get_captions(mediagen_tree)))
-        return videos
-
-
-Rtmp = collections.namedtuple('Rtmp', 'url ext width height')
-
-
-def _get_rtmps(mediagen_tree):
+        return [Video.resolve(feed.show_url, video_blob, fne)
+                for video_blob, fne in make_fnes(feed.video_blobs)]
+
+    @staticmethod
+    def resolve(show_url, video_blob, fne):
+        rtmps, captions = resolve_media(show_url, video_blob.uri)
+        return Video.from_media(video_blob, fne, rtmps, captions)
+
+    @staticmethod
+    def from_media(video_blob, fne, rtmps, captions):
+        return Video(page_url=video_blob.page_url,
+                     episode_url=video_blob.episode_url,
+                     fne=fne,
+                     date=video_blob.date,
+                     rtmps=rtmps,
+                     captions=captions,
+                     uri=video_blob.uri)
+
+    def compact(self):
+        '''Return a copy that keeps only the selected rendition.
+
+        The rendition is selected now rather than when downloading.
+        '''
+        rtmps = (cc.rendition.select(self.rtmps),) if self.rtmps else ()
+        return self._replace(rtmps=rtmps, captions=tuple(self.captions))
+
+
+def make_fnes(video_blobs):
+    '''Generate (video_blob, fne) pairs.'''
+    part_indexes = collections.defaultdict(int)
+    for video_blob in video_blobs:
+        fne = _make_fne(video_blob.page_url)
+        if (video_blob.episode_url is not None and
+                not _look_like_recap_video(video_blob.page_url)):
+            index = part_indexes[video_blob.episode_url] + 1
+            part_indexes[video_blob.episode_url] = index
+            fne = 'part-%d-%s' % (index, fne)
+        yield video_blob, fne
+
+
+Rtmp = collections.namedtuple(
+    'Rtmp', 'url ext width height bitrate duration', defaults=(None, None))
+
+
+def _get_rtmps(renditions):
     rtmps = []
-    for rendition in mediagen_tree.findall('.//rendition'):
+    for rendition in renditions:
         url = rendition.find('./src').text
         url = url.replace('viacomccstrm', 'viacommtvstrm')
         ext = os.path.splitext(urllib.parse.urlparse(url).path)[1] or '.mp4'
         width = int(rendition.get('width'))
         height = int(rendition.get('height'))
-        rtmps.append(Rtmp(url=url, ext=ext, width=width, height=height))
+        rtmps.append(Rtmp(url=url, ext=ext, width=width, height=height,
+                          bitrate=_get_number(rendition, 'bitrate'),
+                          duration=_get_number(rendition, 'duration')))
     return rtmps
 
 
+def _get_number(element, name):
+    try:
+        return float(element.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
 Caption = collections.namedtuple('Caption', 'url ext')
 
 
-def _get_captions(mediagen_tree):
+def _get_captions(typographics):
     captions = []
-    for typographic in mediagen_tree.findall('.//typographic'):
+    for typographic in typographics:
         url = typographic.get('src')
         ext = os.path.splitext(urllib.parse.urlparse(url).path)[1]
         if not ext:
@@ -76,47 +114,51 @@ def _get_captions(mediagen_tree):
     return captions
 
 
-def _get_mediagen_tree(feed, video_blob):
-    parts = urllib.parse.urlparse(feed.show_url)
+def make_mrss_url(show_url, uri):
+    parts = urllib.parse.urlparse(show_url)
     new_parts = urllib.parse.ParseResult(
         scheme=parts.scheme,
         netloc=parts.netloc,
         path='feeds/mrss',
         params='',
-        query=urllib.parse.urlencode({'uri': video_blob.uri}),
+        query=urllib.parse.urlencode({'uri': uri}),
         fragment='')
-    mrss_url = urllib.parse.urlunparse(new_parts)
-    try:
-        mrss_tree = cc.http.get_url_dom_tree(mrss_url)
-    except lxml.etree.XMLSyntaxError:
-        logging.warning('fix mrss xml %s', mrss_url, exc_info=True)
-        mrss_tree = _get_url_dom_tree_with_fixes(mrss_url)
-    content = mrss_tree.find('.//{http://search.yahoo.com/mrss/}content')
-    mediagen_url = content.get('url')
-    try:
-        return cc.http.get_url_dom_tree(mediagen_url)
-    except lxml.etree.XMLSyntaxError:
-        logging.warning('fix mediagen xml %s', mediagen_url, exc_info=True)
-        return _get_url_dom_tree_with_fixes(mediagen_url)
-
-
-def _get_url_dom_tree_with_fixes(url):
-    '''Fix some known syntax errors in the returned xml documents.'''
-    doc = cc.http.get_url_bytes(url)
-    pieces = []
-    # Remove comments within which have double hyphen.
-    comment_end = 0
-    while True:
-        comment_start = doc.find(b'<!--', comment_end)
-        if comment_start == -1:
-            break
-        comment_end = doc.index(b'-->', comment_start) + 3
-        logging.debug('strip: %s', repr(doc[comment_start:comment_end]))
-        pieces.append(doc[0:comment_start])
-        pieces.append(doc[comment_end:])
-    if pieces:
-        doc = b''.join(pieces)
-    return lxml.etree.fromstring(doc)
+    return urllib.parse.urlunparse(new_parts)
+
+
+def resolve_media(show_url, uri):
+    '''Resolve mgid uri into (rtmps, captions) through mrss and mediagen.'''
+    media = cc.mediacache.get(uri)
+    if media is not None:
+        return ([Rtmp(**rtmp) for rtmp in media['rtmps']],
+                [Caption(**caption) for caption in media['captions']])
+    with cc.memory.stage('resolve'):
+        rtmps, captions = get_media(
+            get_mediagen_url(make_mrss_url(show_url, uri)))
+    cc.mediacache.put(uri, {
+        'rtmps': [rtmp._asdict() for rtmp in rtmps],
+        'captions': [caption._asdict() for caption in captions],
+    })
+    return rtmps, captions
+
+
+_TAG_MRSS_CONTENT = '{http://search.yahoo.com/mrss/}content'
+
+
+def get_mediagen_url(mrss_url):
+    content = _get_xml_elements(mrss_url, (_TAG_MRSS_CONTENT,))[0]
+    return content.get('url')
+
+
+def get_media(mediagen_url):
+    '''Fetch mediagen document and return (rtmps, captions).'''
+    elements = _get_xml_elements(mediagen_url, ('rendition', 'typographic'))
+    return (_get_rtmps(e for e in elements if e.tag == 'rendition'),
+            _get_captions(e for e in elements if e.tag == 'typographic'))
+
+
+def _get_xml_elements(url, tags):
+    return cc.http.get_url_xml_elements(url, tags, recover=cc.xmlfix.parse)
 
 
 _PATTERN_RECAP_VIDEO = re.compile(r'in-+60-+seconds|recap-+week-+of')
@@ -0,0 +1,105 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Fix known defects of malformed xml documents.
+
+The mrss/mediagen documents sometimes have comments with double hyphens
+within, bare ampersands, or control characters that xml forbids.  We
+fix all of them in one linear pass over the bytes, and fall back to
+lxml's recovering parser if the result is still malformed.
+'''
+
+__all__ = [
+    'get_counts',
+    'parse',
+    'sanitize',
+]
+
+import collections
+import re
+import threading
+
+import lxml.etree
+
+import cc
+import cc.inits
+import cc.metrics
+
+from cc import logging
+
+
+_lock = threading.Lock()
+_counts = collections.Counter()
+
+
+@cc.inits.final
+def final_xmlfix():
+    counts = get_counts()
+    if counts:
+        logging.info('xmlfix: %s', ' '.join(
+            '%s=%d' % item for item in sorted(counts.items())))
+
+
+def get_counts():
+    '''Return counts of each kind of fix applied so far.'''
+    with _lock:
+        return collections.Counter(_counts)
+
+
+_FIXES = cc.metrics.counter(
+    'cc_xmlfix_fixes_total', 'Fixes applied to malformed xml documents.',
+    ('kind',))
+
+
+_PATTERN_DEFECTS = re.compile(
+    # CDATA sections are left as they are.
+    rb'(?P<cdata><!\[CDATA\[.*?\]\]>)|'
+    # Comments (which may contain double hyphens).
+    rb'(?P<comment><!--.*?-->)|'
+    # Ampersands that do not start an entity or character reference.
+    rb'(?P<ampersand>&(?![A-Za-z][A-Za-z0-9]*;|#[0-9]+;|#x[0-9A-Fa-f]+;))|'
+    # Control characters that are not allowed in xml 1.0.
+    rb'(?P<control>[\x00-\x08\x0b\x0c\x0e-\x1f])',
+    re.DOTALL)
+
+_REPLACEMENTS = {
+    'comment': b'',
+    'ampersand': b'&amp;',
+    'control': b'',
+}
+
+
+def sanitize(doc):
+    '''Return (fixed_doc, counts) of doc (bytes).'''
+    counts = collections.Counter()
+
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'cdata':
+            return match.group()
+        counts[kind] += 1
+        return _REPLACEMENTS[kind]
+
+    doc = _PATTERN_DEFECTS.sub(replace, doc)
+    return doc, counts
+
+
+def parse(doc):
+    '''Parse a malformed document (bytes) into a tree.'''
+    doc, counts = sanitize(doc)
+    try:
+        tree = lxml.etree.fromstring(doc)
+    except lxml.etree.XMLSyntaxError:
+        logging.warning('xmlfix: recover', exc_info=True)
+        counts['recover'] += 1
+        parser = lxml.etree.XMLParser(recover=True)
+        tree = lxml.etree.fromstring(doc, parser)
+        if tree is None:
+            raise
+    logging.debug('xmlfix: fixes: %s', dict(counts))
+    with _lock:
+        _counts.update(counts)
+    for kind, count in counts.items():
+        _FIXES.inc(count, kind=kind)
+    return tree
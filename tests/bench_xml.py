@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+'''Compare peak memory and time of parsing a large xml document while
+it is being downloaded (cc.http.get_url_xml_elements) against parsing
+the whole body.
+
+Usage: bench_xml.py [NUM_ITEMS]
+'''
+
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] in ('stream', 'full'):
+        return run(argv[1], argv[2])
+    num_items = int(argv[1]) if len(argv) > 1 else 200000
+    with tempfile.NamedTemporaryFile(suffix='.xml') as doc:
+        generate(doc, num_items)
+        doc.flush()
+        print('document: %.1f MB, %d items' %
+              (os.path.getsize(doc.name) / 2**20, num_items))
+        for mode in ('stream', 'full'):
+            # A process of its own for each, so that peaks do not mix.
+            output = subprocess.check_output(
+                [sys.executable, __file__, mode, doc.name],
+                universal_newlines=True)
+            print('%s: %s' % (mode, output.strip()))
+    return 0
+
+
+def generate(output_file, num_items):
+    '''Write a mediagen-like document, in which one of every hundred
+    items has a rendition (the elements that we keep).
+    '''
+    output_file.write(b'<?xml version="1.0"?>\n<package><video>\n')
+    for i in range(num_items):
+        output_file.write(
+            b'<item><title>Episode %d</title><description>%s</description>'
+            % (i, b'x' * 200))
+        if i % 100 == 0:
+            output_file.write(
+                b'<rendition width="640" height="360" type="video/mp4">'
+                b'<src>rtmp://example.com/%d.mp4</src></rendition>' % i)
+        output_file.write(b'</item>\n')
+    output_file.write(b'</video></package>\n')
+
+
+def run(mode, path):
+    import lxml.etree
+    import cc.http
+    import cc.xmlfix
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'stream':
+        elements = cc.http._parse_xml_elements(
+            _FileResponse(path), frozenset(['rendition']),
+            recover=cc.xmlfix.parse)
+    else:
+        with open(path, 'rb') as input_file:
+            body = input_file.read()
+        elements = list(lxml.etree.fromstring(body).iter('rendition'))
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux.
+    print('%d elements, %.2f s, peak +%.1f MB' %
+          (len(elements), seconds, (after - before) / 1024))
+    return 0
+
+
+class _FileResponse:
+    '''Stand in for a streaming response of the file.'''
+
+    def __init__(self, path):
+        self.url = 'file://' + path
+        self._path = path
+
+    def iter_content(self, chunk_size):
+        with open(self._path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(chunk_size), b''):
+                yield chunk
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
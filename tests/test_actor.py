@@ -0,0 +1,108 @@
+# Copyright (C) 2014 Che-Liang Chiou.  All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# cc.statics is write-once, and so each run has a process of its own.
+KILL_CHILD = '''
+import os, signal, sys
+import cc, cc.actor, cc.inits, cc.main
+
+results = []
+
+@cc.actor.actor(process=True)
+def die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+@cc.actor.actor(process=True)
+def work(number):
+    record(number)
+
+@cc.actor.actor
+def record(number):
+    results.append(number)
+
+cc.statics.argv = ['x', '--start', '2014-01-01', '--end', '2014-02-01',
+                   '--output', sys.argv[1], '--processes', '1',
+                   '--jobs', '2', 'http://x/']
+cc.inits.run_inits()
+die()
+cc.actor.join()
+work(1)
+cc.actor.join()
+print(results)
+cc.inits.run_finals()
+'''
+
+CHILD_METRICS = '''
+import sys
+import cc, cc.actor, cc.inits, cc.main, cc.metrics
+
+COUNT = cc.metrics.counter('test_count_total', 'Test.', ('where',))
+SECONDS = cc.metrics.histogram('test_seconds', 'Test.', buckets=(1,))
+
+@cc.actor.actor(process=True)
+def work():
+    COUNT.inc(where='child')
+    SECONDS.observe(0.5)
+
+cc.statics.argv = ['x', '--start', '2014-01-01', '--end', '2014-02-01',
+                   '--output', sys.argv[1], '--processes', '2', 'http://x/']
+cc.inits.run_inits()
+COUNT.inc(where='parent')
+for _ in range(5):
+    work()
+cc.actor.join()
+print(cc.metrics.render())
+cc.inits.run_finals()
+'''
+
+
+class ProcessesTest(unittest.TestCase):
+
+    def test_child_killed(self):
+        # The message of the killed child fails (rather than waiting
+        # forever for the child), and later ones are still processed.
+        result = _run(KILL_CHILD)
+        self.assertEqual(result.stdout.strip(), '[1]')
+        self.assertIn('Could not process in child process', result.stderr)
+
+    def test_child_metrics(self):
+        result = _run(CHILD_METRICS)
+        lines = result.stdout.splitlines()
+        self.assertIn('test_count_total{where="child"} 5', lines)
+        self.assertIn('test_count_total{where="parent"} 1', lines)
+        self.assertIn('test_seconds_count 5', lines)
+
+
+def _run(script):
+    with tempfile.TemporaryDirectory() as output:
+        # The initializers look for (but we do not run) rtmpdump.
+        rtmpdump = os.path.join(output, 'rtmpdump')
+        with open(rtmpdump, 'w') as rtmpdump_file:
+            rtmpdump_file.write('#!/bin/sh\n')
+        os.chmod(rtmpdump, 0o755)
+        env = dict(os.environ, PYTHONPATH=ROOT,
+                   PATH=output + os.pathsep + os.environ['PATH'])
+        result = subprocess.run(
+            [sys.executable, '-c', script, output],
+            cwd=ROOT, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=60)
+    if result.returncode != 0:
+        raise AssertionError(result.stderr)
+    return result
+
+
+if __name__ == '__main__':
+    unittest.main()